@@ -2,14 +2,23 @@ from dotenv import load_dotenv
 
 load_dotenv()
 
-from fastapi import FastAPI
+import asyncio
+
+from fastapi import FastAPI, Response
 from fastapi.middleware.cors import CORSMiddleware
+from prometheus_client import CONTENT_TYPE_LATEST, generate_latest
 
 from modules import routers, database
+from modules.local_cache import LocalCache
+from modules.materializer import CHART_MATERIALIZE_INTERVAL, materialize_periodically
+from modules.metrics import MetricsMiddleware
+from modules.profiling import PROFILING_ENABLED, ProfilingMiddleware, profiling_router
+from modules.responses import FastJSONResponse
 
 app = FastAPI(
     title="ITMOCHART",
     description="ICT Hack #3 2021",
+    default_response_class=FastJSONResponse,
 )
 DB = database.MongoDbWrapper()
 
@@ -20,6 +29,45 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+app.add_middleware(MetricsMiddleware)
+
+if PROFILING_ENABLED:
+    app.add_middleware(ProfilingMiddleware)
+    app.include_router(router=profiling_router, tags=["Profiling Endpoints"])
+
+
+@app.on_event("startup")
+async def reconcile_indexes() -> None:
+    await DB.ensure_indexes()
+
+
+@app.on_event("startup")
+async def listen_cache_invalidations() -> None:
+    app.state.cache_invalidation_listener = asyncio.create_task(LocalCache.listen())
+
+
+@app.on_event("shutdown")
+async def stop_listening_cache_invalidations() -> None:
+    app.state.cache_invalidation_listener.cancel()
+
+
+@app.on_event("startup")
+async def schedule_chart_materialization() -> None:
+    if CHART_MATERIALIZE_INTERVAL > 0:
+        app.state.chart_materializer = asyncio.create_task(materialize_periodically(CHART_MATERIALIZE_INTERVAL))
+
+
+@app.on_event("shutdown")
+async def stop_chart_materialization() -> None:
+    if CHART_MATERIALIZE_INTERVAL > 0:
+        app.state.chart_materializer.cancel()
+
+
+@app.get("/metrics", include_in_schema=False)
+async def metrics() -> Response:
+    """Prometheus exposition of the process metrics"""
+    return Response(content=generate_latest(), media_type=CONTENT_TYPE_LATEST)
+
 
 app.include_router(router=routers.service_router, tags=["Service Endpoints"])
 app.include_router(router=routers.user_router, tags=["User Management Endpoints"])
@@ -0,0 +1,247 @@
+"""
+Drive the API hot paths in-process and report throughput and latency percentiles as JSON.
+
+The app is served through ASGI without a network hop. A synthetic dataset is seeded from
+modules.generator first. The database is a local mongod given with --mongo, otherwise an
+in-process mongomock stand-in. Redis is a local server given with --redis, otherwise fakeredis.
+The stand-in has no transactions, so checkout runs the way it does on a standalone mongod.
+
+    python -m benchmarks.api --students 2000 --requests 500 --concurrency 16 --output before.json
+    python -m benchmarks.api --mongo "mongodb://localhost:27017/?appname=benchmarks" --reset \\
+        --redis redis://localhost:6379 --scenarios chart-hit,chart-miss,me
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import statistics
+import subprocess
+import sys
+import time
+import typing as tp
+from urllib.parse import urlparse
+
+import httpx
+
+SCENARIOS = ("chart-hit", "chart-miss", "login", "me", "checkout", "award")
+PASSWORD = "password"
+
+
+def _use_stand_ins(args: argparse.Namespace) -> None:
+    """point the app at local servers or in-process stand-ins, has to run before the app is imported"""
+    os.environ.setdefault("SECRET_KEY", "benchmarks")
+
+    if args.mongo:
+        os.environ["MONGO_CONNECTION_URL"] = args.mongo
+        os.environ["MONGO_TLS"] = "0"
+    else:
+        import motor.motor_asyncio
+        from mongomock_motor import AsyncMongoMockClient
+
+        motor.motor_asyncio.AsyncIOMotorClient = AsyncMongoMockClient
+        os.environ["MONGO_CONNECTION_URL"] = "mongodb://localhost:27017/?appname=benchmarks"
+        os.environ["MONGO_TLS"] = "0"
+
+    if args.redis:
+        url = urlparse(args.redis)
+        os.environ["REDIS_HOST"] = url.hostname or "localhost"
+        os.environ["REDIS_PORT"] = str(url.port or 6379)
+    else:
+        import fakeredis
+        import fakeredis.aioredis
+        import redis.asyncio
+
+        server = fakeredis.FakeServer()
+        redis.asyncio.Redis = lambda *_, **__: fakeredis.aioredis.FakeRedis(server=server)
+
+
+def _percentiles(samples: tp.List[float]) -> tp.Dict[str, float]:
+    if len(samples) < 2:
+        return {"p50_ms": 0.0, "p95_ms": 0.0, "p99_ms": 0.0}
+    cuts = statistics.quantiles(samples, n=100)
+    return {"p50_ms": round(cuts[49] * 1e3, 2), "p95_ms": round(cuts[94] * 1e3, 2), "p99_ms": round(cuts[98] * 1e3, 2)}
+
+
+def _commit() -> tp.Optional[str]:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+async def _drive(
+    requests: int,
+    concurrency: int,
+    send: tp.Callable[[int], tp.Awaitable[httpx.Response]],
+    setup: tp.Optional[tp.Callable[[int], tp.Awaitable[None]]] = None,
+) -> tp.Dict[str, tp.Any]:
+    """
+    send requests from concurrent workers, statuses are the ones reported in the response body.
+    the setup runs before every request and is left out of its latency, though not out of the throughput
+    """
+    latencies: tp.List[float] = []
+    statuses: tp.Dict[str, int] = {}
+    remaining = iter(range(requests))
+
+    async def worker() -> None:
+        for number in remaining:
+            if setup is not None:
+                await setup(number)
+            started = time.perf_counter()
+            response = await send(number)
+            latencies.append(time.perf_counter() - started)
+
+            body = response.json() if response.headers.get("content-type") == "application/json" else None
+            status = str(body.get("status_code", response.status_code)) if isinstance(body, dict) else str(
+                response.status_code
+            )
+            statuses[status] = statuses.get(status, 0) + 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*[worker() for _ in range(concurrency)])
+    elapsed = time.perf_counter() - started
+
+    return {
+        "requests": requests,
+        "elapsed_s": round(elapsed, 3),
+        "throughput_rps": round(requests / elapsed, 1),
+        **_percentiles(latencies),
+        "statuses": statuses,
+    }
+
+
+async def run(args: argparse.Namespace) -> tp.Dict[str, tp.Any]:
+    from pymongo.errors import BulkWriteError
+
+    from app import DB, app
+    from modules.chart_cache import ChartCache
+    from modules.generator import DatasetGenerator, write_mongo
+    from modules.leaderboard import LeaderboardEngine
+    from modules.routers.presentator.dependencies import CHART_PAGE_LIMIT
+    from modules.routers.presentator.models import ChartScope
+    from modules.structure import university_structure
+
+    groups = sum(len(programs) for faculties in university_structure.values() for programs in faculties.values())
+    generator = DatasetGenerator(
+        seed=args.seed,
+        students_per_group=max(args.students // groups, 1),
+        achievements_per_student=args.achievements_per_student,
+        password=PASSWORD,
+    )
+
+    if args.reset:
+        await DB._client.drop_database("itmochart")
+    try:
+        await write_mongo(generator, batch_size=1000)
+    except BulkWriteError:
+        raise SystemExit("the database is not empty, pass --reset to drop it before seeding")
+
+    if not args.mongo:
+        # the stand-in can not report its topology
+        DB._transactions = False
+    await app.router.startup()
+    await LeaderboardEngine().rebuild()
+    await ChartCache().invalidate_all()
+
+    rng = random.Random(args.seed)
+    teacher = generator.teachers()[0]
+    students = [str(100001 + number) for number in range(generator.students_count)]
+    reward = min(generator.rewards, key=lambda reward: reward.price)
+    template = generator.achievement_templates[0]
+    results: tp.Dict[str, tp.Any] = {}
+
+    async with httpx.AsyncClient(app=app, base_url="http://benchmarks", timeout=60) as client:
+
+        async def chart_miss(number: int) -> httpx.Response:
+            offset = number % len(students) // CHART_PAGE_LIMIT * CHART_PAGE_LIMIT
+            return await client.get("/chart/", params={"offset": offset, "limit": CHART_PAGE_LIMIT})
+
+        async def evict_chart(_: int) -> None:
+            # only aligned pages are cached, so the chart is evicted before each of them is asked for
+            await ChartCache().invalidate(ChartScope())
+
+        async def login(isu_id: str) -> tp.Dict[str, str]:
+            token = (await client.post("/user/login", data={"username": isu_id, "password": PASSWORD})).json()
+            return {"Authorization": f"Bearer {token['access_token']}"}
+
+        teacher_headers = await login(teacher.isu_id)
+        student_headers = [await login(isu_id) for isu_id in rng.sample(students, min(args.concurrency, len(students)))]
+
+        scenarios: tp.Dict[str, tp.Callable[[int], tp.Awaitable[httpx.Response]]] = {
+            "chart-hit": lambda _: client.get("/chart/"),
+            "chart-miss": chart_miss,
+            "login": lambda _: client.post(
+                "/user/login",
+                data={"username": rng.choice(students), "password": PASSWORD},
+            ),
+            "me": lambda number: client.get("/user/me", headers=student_headers[number % len(student_headers)]),
+            "checkout": lambda number: client.post(
+                "/service/checkout",
+                params={"reward_id": reward.id},
+                headers=student_headers[number % len(student_headers)],
+            ),
+            "award": lambda _: client.post(
+                "/service/achievements",
+                params={"achievement_template_id": template.id, "isu_id": rng.choice(students)},
+                headers=teacher_headers,
+            ),
+        }
+        setups: tp.Dict[str, tp.Callable[[int], tp.Awaitable[None]]] = {"chart-miss": evict_chart}
+
+        for name in args.scenarios:
+            if name == "chart-hit":
+                await client.get("/chart/")
+            if name == "chart-miss":
+                await ChartCache().invalidate_all()
+            requests = args.login_requests if name == "login" else args.requests
+            results[name] = await _drive(requests, args.concurrency, scenarios[name], setups.get(name))
+
+    await app.router.shutdown()
+
+    return {
+        "commit": _commit(),
+        "python": sys.version.split()[0],
+        "mongo": "mongod" if args.mongo else "stand-in",
+        "redis": "server" if args.redis else "fakeredis",
+        "students": generator.students_count,
+        "concurrency": args.concurrency,
+        "scenarios": results,
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--mongo", help="connection url of a local mongod, the in-process stand-in otherwise")
+    parser.add_argument("--reset", action="store_true", help="drop the itmochart database before seeding")
+    parser.add_argument("--redis", help="url of a local redis server, fakeredis otherwise")
+    parser.add_argument("--students", type=int, default=2000, help="approximate size of the seeded dataset")
+    parser.add_argument("--achievements-per-student", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--requests", type=int, default=500, help="requests per scenario")
+    parser.add_argument("--login-requests", type=int, default=50, help="requests of the bcrypt bound login scenario")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument(
+        "--scenarios",
+        type=lambda value: [name for name in value.split(",") if name],
+        default=list(SCENARIOS),
+        help=f"comma separated subset of {','.join(SCENARIOS)}",
+    )
+    parser.add_argument("--output", help="write the report to the file as well")
+    args = parser.parse_args()
+
+    unknown = set(args.scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"unknown scenarios: {', '.join(sorted(unknown))}")
+
+    _use_stand_ins(args)
+    report = asyncio.get_event_loop().run_until_complete(run(args))
+
+    print(json.dumps(report, indent=2))
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump(report, output, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,77 @@
+"""
+Measure POST /service/achievements latency and check that concurrent awards to one student are not lost.
+
+Sequential awards give the latency of the award path itself, concurrent awards to the same student
+give the lost update check: the student's points have to grow by exactly awards * template value.
+
+    python -m benchmarks.award_latency --url http://localhost:5000 --username <teacher> --password <password> \\
+        --template <achievement template id> --student <student isu id>
+"""
+import argparse
+import asyncio
+import json
+import statistics
+import time
+import typing as tp
+
+import httpx
+
+
+def _percentiles(samples: tp.List[float]) -> tp.Dict[str, float]:
+    cuts = statistics.quantiles(samples, n=100)
+    return {"p50_ms": round(cuts[49] * 1e3, 2), "p95_ms": round(cuts[94] * 1e3, 2), "p99_ms": round(cuts[98] * 1e3, 2)}
+
+
+async def _student_points(client: httpx.AsyncClient, headers: tp.Dict[str, str], isu_id: str) -> int:
+    users = (await client.get("/user/users", headers=headers)).json()["users"]
+    return next(user["points"] for user in users if user["isu_id"] == isu_id)
+
+
+async def run(args: argparse.Namespace) -> tp.Dict[str, tp.Any]:
+    params = {"achievement_template_id": args.template, "isu_id": args.student}
+
+    async with httpx.AsyncClient(base_url=args.url, timeout=60) as client:
+        token = (await client.post("/user/login", data={"username": args.username, "password": args.password})).json()
+        headers = {"Authorization": f"Bearer {token['access_token']}"}
+        templates = (await client.get("/service/achievements")).json()["achievement_templates"]
+        value = next(template["value"] for template in templates if template["id"] == args.template)
+
+        latencies = []
+        for _ in range(args.awards):
+            started = time.perf_counter()
+            response = await client.post("/service/achievements", params=params, headers=headers)
+            latencies.append(time.perf_counter() - started)
+            assert response.json()["status_code"] == 200, response.text
+
+        points_before = await _student_points(client, headers, args.student)
+        await asyncio.gather(
+            *[client.post("/service/achievements", params=params, headers=headers) for _ in range(args.concurrent)]
+        )
+        points_after = await _student_points(client, headers, args.student)
+
+    return {
+        "sequential_awards": args.awards,
+        "latency": _percentiles(latencies),
+        "concurrent_awards": args.concurrent,
+        "expected_points_gain": args.concurrent * value,
+        "actual_points_gain": points_after - points_before,
+        "lost_updates": (args.concurrent * value - (points_after - points_before)) // value,
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", default="http://localhost:5000")
+    parser.add_argument("--username", required=True, help="isu id of a teacher with write permission")
+    parser.add_argument("--password", required=True)
+    parser.add_argument("--template", required=True, help="achievement template id")
+    parser.add_argument("--student", required=True, help="isu id of the awarded student")
+    parser.add_argument("--awards", type=int, default=200, help="number of sequential awards")
+    parser.add_argument("--concurrent", type=int, default=50, help="number of concurrent awards")
+    args = parser.parse_args()
+
+    print(json.dumps(asyncio.run(run(args)), indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,141 @@
+"""
+Compare chart cache formats: the legacy repr/eval payload against the pre-serialized response body.
+
+Both formats are read back from Redis, a local server given with --redis, otherwise fakeredis. The legacy hit
+is a GET followed by eval, per-row validation, the response model and stdlib serialization. The body is written
+by ChartCache.put and read by ChartCache.get, once from Redis with the local tier emptied before every hit and
+once from the local tier. Reports the wall time of a hit, from the lookup to the response bytes, and the stored size.
+
+    python -m benchmarks.chart_cache_encoding --rows 100 --runs 2000
+    python -m benchmarks.chart_cache_encoding --redis redis://localhost:6379
+"""
+import os
+
+os.environ.setdefault("MONGO_CONNECTION_URL", "mongodb://localhost:27017/?appname=benchmarks")
+
+import argparse
+import asyncio
+import json
+import random
+import time
+import typing as tp
+from urllib.parse import urlparse
+
+from pydantic import parse_obj_as
+
+
+def _use_redis(url: tp.Optional[str]) -> None:
+    """point the cache at a local server or at fakeredis, has to run before the cache is created"""
+    if url:
+        parsed = urlparse(url)
+        os.environ["REDIS_HOST"] = parsed.hostname or "localhost"
+        os.environ["REDIS_PORT"] = str(parsed.port or 6379)
+    else:
+        import fakeredis
+        import fakeredis.aioredis
+        import redis.asyncio
+
+        server = fakeredis.FakeServer()
+        redis.asyncio.Redis = lambda *_, **__: fakeredis.aioredis.FakeRedis(server=server)
+
+
+def _make_chart(rows: int) -> tp.Any:
+    from modules.routers.presentator.models import Chart, ChartEntry
+
+    rng = random.Random(0)
+    chart_data = [
+        ChartEntry(
+            name=f"Иванов Иван Иванович {position}",
+            megafaculty="МФ КТУ",
+            faculty="ФПИиКТ",
+            program="Программная инженерия",
+            group="P3120",
+            points=rng.randint(0, 1000),
+            rating_position=position,
+        )
+        for position in range(1, rows + 1)
+    ]
+    return Chart(detail=f"Success gathering chart of {rows} rows", chart_data=chart_data)
+
+
+async def _time_hits(
+    hit: tp.Callable[[], tp.Awaitable[tp.Optional[bytes]]],
+    runs: int,
+    before: tp.Optional[tp.Callable[[], None]] = None,
+) -> float:
+    """mean seconds per hit, the setup before every hit is not timed"""
+    elapsed = 0.0
+    for _ in range(runs):
+        if before is not None:
+            before()
+        started = time.perf_counter()
+        body = await hit()
+        elapsed += time.perf_counter() - started
+        if body is None:
+            raise AssertionError("the chart is not cached")
+    return elapsed / runs
+
+
+async def run(args: argparse.Namespace) -> tp.Dict[str, tp.Any]:
+    from modules import routers  # noqa: F401  routers go first, the rest of the modules import them
+    from modules.cache import AsyncCache
+    from modules.chart_cache import ChartCache
+    from modules.routers.presentator.models import Chart, ChartEntry, ChartPage, ChartScope
+
+    cache = AsyncCache()
+    chart_cache = ChartCache()
+    chart = _make_chart(args.rows)
+    page = ChartPage(scope=ChartScope(kind="group", value="P3120"), offset=0, limit=args.rows)
+
+    legacy_key = "benchmarks:chart-cache-encoding:legacy"
+    legacy_stored = repr([entry.dict() for entry in chart.chart_data]).encode()
+    await cache.set(legacy_key, legacy_stored, ttl=600)
+
+    async def legacy_hit() -> tp.Optional[bytes]:
+        stored = await cache.get(legacy_key)
+        if stored is None:
+            return None
+        chart_data = [parse_obj_as(ChartEntry, entry) for entry in eval(stored)]
+        legacy = Chart(detail=f"Success gathering chart of {len(chart_data)} rows", chart_data=chart_data)
+        return json.dumps(legacy.dict(), ensure_ascii=False, separators=(",", ":")).encode()
+
+    await chart_cache.invalidate(page.scope)
+    body = await chart_cache.put(page, chart, await chart_cache.generation(page.scope))
+    if json.loads(body)["chart_data"] != json.loads(await legacy_hit() or b"{}").get("chart_data"):
+        raise AssertionError("both formats have to produce the same chart")
+
+    timings = {
+        "legacy repr/eval": (len(legacy_stored), await _time_hits(legacy_hit, args.runs)),
+        "serialized body, redis tier": (
+            len(body),
+            await _time_hits(lambda: chart_cache.get(page), args.runs, before=chart_cache._local.clear),
+        ),
+        "serialized body, local tier": (len(body), await _time_hits(lambda: chart_cache.get(page), args.runs)),
+    }
+
+    await cache.delete(legacy_key)
+    await chart_cache.invalidate(page.scope)
+
+    return {
+        "rows": args.rows,
+        "runs": args.runs,
+        "redis": args.redis or "fakeredis",
+        "results": {
+            name: {"bytes_stored": size, "hit_us": round(seconds * 1e6, 2)} for name, (size, seconds) in timings.items()
+        },
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=100)
+    parser.add_argument("--runs", type=int, default=2000)
+    parser.add_argument("--redis", help="redis://host:port of a local server, fakeredis by default")
+    args = parser.parse_args()
+
+    _use_redis(args.redis)
+    print(json.dumps(asyncio.run(run(args)), ensure_ascii=False, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,87 @@
+"""
+Measure /chart/ latency on its own and while the server is flooded with logins.
+
+With bcrypt on the event loop the chart p99 grows with the number of concurrent logins,
+with bcrypt offloaded to the hasher pool it has to stay flat.
+
+    python -m benchmarks.login_storm --url http://localhost:5000 --username 100001 --password secret
+"""
+import argparse
+import asyncio
+import json
+import statistics
+import time
+import typing as tp
+
+import httpx
+
+
+def _percentiles(samples: tp.List[float]) -> tp.Dict[str, float]:
+    if len(samples) < 2:
+        return {"p50_ms": 0.0, "p95_ms": 0.0, "p99_ms": 0.0}
+    cuts = statistics.quantiles(samples, n=100)
+    return {"p50_ms": round(cuts[49] * 1e3, 2), "p95_ms": round(cuts[94] * 1e3, 2), "p99_ms": round(cuts[98] * 1e3, 2)}
+
+
+async def _chart_latencies(client: httpx.AsyncClient, requests: int, concurrency: int) -> tp.List[float]:
+    latencies: tp.List[float] = []
+    remaining = iter(range(requests))
+
+    async def worker() -> None:
+        for _ in remaining:
+            started = time.perf_counter()
+            await client.get("/chart/")
+            latencies.append(time.perf_counter() - started)
+
+    await asyncio.gather(*[worker() for _ in range(concurrency)])
+    return latencies
+
+
+async def _login_storm(client: httpx.AsyncClient, args: argparse.Namespace, stop: asyncio.Event) -> tp.Dict[str, int]:
+    statuses: tp.Dict[str, int] = {}
+
+    async def worker() -> None:
+        while not stop.is_set():
+            response = await client.post("/user/login", data={"username": args.username, "password": args.password})
+            statuses[str(response.status_code)] = statuses.get(str(response.status_code), 0) + 1
+
+    await asyncio.gather(*[worker() for _ in range(args.logins)])
+    return statuses
+
+
+async def run(args: argparse.Namespace) -> tp.Dict[str, tp.Any]:
+    async with httpx.AsyncClient(base_url=args.url, timeout=60) as client:
+        await client.get("/chart/")  # warm the chart cache up
+
+        baseline = await _chart_latencies(client, args.requests, args.concurrency)
+
+        stop = asyncio.Event()
+        storm = asyncio.create_task(_login_storm(client, args, stop))
+        await asyncio.sleep(1)  # let the storm saturate the hasher
+        during_storm = await _chart_latencies(client, args.requests, args.concurrency)
+        stop.set()
+        login_statuses = await storm
+
+    return {
+        "chart_baseline": _percentiles(baseline),
+        "chart_during_login_storm": _percentiles(during_storm),
+        "concurrent_logins": args.logins,
+        "login_statuses": login_statuses,
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", default="http://localhost:5000")
+    parser.add_argument("--username", required=True)
+    parser.add_argument("--password", required=True)
+    parser.add_argument("--logins", type=int, default=64, help="number of clients logging in non-stop")
+    parser.add_argument("--requests", type=int, default=500, help="chart requests per measurement")
+    parser.add_argument("--concurrency", type=int, default=8, help="concurrent chart clients")
+    args = parser.parse_args()
+
+    print(json.dumps(asyncio.run(run(args)), indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,78 @@
+"""
+Measure what the metrics instrumentation adds to the hot paths.
+
+Compares a bare coroutine with the same coroutine wrapped like the MongoDbWrapper methods, and
+a trivial ASGI app with the same app behind MetricsMiddleware. Reports microseconds per call.
+
+    python -m benchmarks.metrics_overhead --runs 100000
+"""
+import argparse
+import asyncio
+import json
+import time
+import typing as tp
+
+from modules.metrics import MetricsMiddleware, _observed
+
+
+async def _query() -> tp.List[int]:
+    return [1, 2, 3]
+
+
+async def _asgi_app(scope: tp.Dict[str, tp.Any], receive: tp.Any, send: tp.Any) -> None:
+    await send({"type": "http.response.start", "status": 200, "headers": []})
+    await send({"type": "http.response.body", "body": b"{}"})
+
+
+async def _per_call(call: tp.Callable[[], tp.Awaitable[tp.Any]], runs: int) -> float:
+    started = time.perf_counter()
+    for _ in range(runs):
+        await call()
+    return (time.perf_counter() - started) / runs * 1e6
+
+
+async def run(args: argparse.Namespace) -> tp.Dict[str, tp.Any]:
+    observed_query = _observed("benchmark", _query)
+
+    class _App:
+        routes: tp.List[tp.Any] = []
+
+    async def receive() -> tp.Dict[str, tp.Any]:
+        return {"type": "http.request", "body": b""}
+
+    async def send(_: tp.Dict[str, tp.Any]) -> None:
+        return None
+
+    scope = {"type": "http", "method": "GET", "path": "/", "app": _App()}
+    instrumented_app = MetricsMiddleware(_asgi_app)
+
+    bare_query = await _per_call(_query, args.runs)
+    instrumented_query = await _per_call(observed_query, args.runs)
+    bare_request = await _per_call(lambda: _asgi_app(dict(scope), receive, send), args.runs)
+    instrumented_request = await _per_call(lambda: instrumented_app(dict(scope), receive, send), args.runs)
+
+    return {
+        "runs": args.runs,
+        "query_us": {
+            "bare": round(bare_query, 3),
+            "instrumented": round(instrumented_query, 3),
+            "overhead": round(instrumented_query - bare_query, 3),
+        },
+        "request_us": {
+            "bare": round(bare_request, 3),
+            "instrumented": round(instrumented_request, 3),
+            "overhead": round(instrumented_request - bare_request, 3),
+        },
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=100000)
+    args = parser.parse_args()
+
+    print(json.dumps(asyncio.run(run(args)), indent=2))
+
+
+if __name__ == "__main__":
+    main()
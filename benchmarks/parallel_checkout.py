@@ -0,0 +1,116 @@
+"""
+Fire concurrent purchases of one reward by one user and check that neither the balance nor the stock is overdrawn.
+
+Creates a dedicated user and reward in the database from MONGO_CONNECTION_URL, then drives /service/checkout
+of a running server. With a read-modify-write checkout the number of successful purchases exceeds
+what the balance and the stock allow, with the atomic one it matches exactly.
+
+Against a replica set checkout runs in a transaction and concurrent purchases abort each other with write conflicts,
+which have to be retried rather than answered with 500; pass --require-transactions to make sure that branch runs.
+A single node replica set is enough: mongod --replSet rs0, then mongosh --eval "rs.initiate()".
+
+    python -m benchmarks.parallel_checkout --url http://localhost:5000 --purchases 200 --stock 50
+    python -m benchmarks.parallel_checkout --url http://localhost:5000 --require-transactions
+"""
+from dotenv import load_dotenv
+
+load_dotenv()
+
+import argparse
+import asyncio
+import json
+import time
+import typing as tp
+from datetime import datetime
+from uuid import uuid4
+
+import httpx
+
+from modules import routers  # noqa: F401  # routers have to be initialized before the rest of the modules
+from modules.database import MongoDbWrapper
+from modules.routers.service.models import Reward
+from modules.routers.user.models import UserWithPassword
+from modules.security import get_password_hash
+
+
+async def run(args: argparse.Namespace) -> tp.Dict[str, tp.Any]:
+    db = MongoDbWrapper()
+    # the server is assumed to use the same database, so it takes the same checkout branch
+    transactions = await db._supports_transactions()
+    if args.require_transactions and not transactions:
+        raise SystemExit("the database is a standalone server, checkout runs without transactions there")
+
+    password = uuid4().hex
+    buyer = UserWithPassword(
+        name="Benchmark Buyer",
+        birth_date=datetime(2000, 1, 1),
+        isu_id=f"bench-{uuid4().hex[:8]}",
+        date_created=datetime.now(),
+        permissions=["read"],
+        megafaculty="benchmark",
+        is_teacher=True,  # keeps the buyer out of the charts
+        faculty="benchmark",
+        program=None,
+        coins=args.price * args.affordable,
+        hashed_password=get_password_hash(password),
+    )
+    reward = Reward(name="Benchmark Reward", price=args.price, description="benchmark", count=args.stock)
+    await db.add_user(buyer)
+    await db.add_reward(reward)
+
+    async with httpx.AsyncClient(base_url=args.url, timeout=60) as client:
+        token = (await client.post("/user/login", data={"username": buyer.isu_id, "password": password})).json()
+        headers = {"Authorization": f"Bearer {token['access_token']}"}
+
+        started = time.perf_counter()
+        responses = await asyncio.gather(
+            *[
+                client.post("/service/checkout", params={"reward_id": reward.id}, headers=headers)
+                for _ in range(args.purchases)
+            ]
+        )
+        elapsed = time.perf_counter() - started
+
+    statuses: tp.Dict[str, int] = {}
+    for response in responses:
+        detail = response.json()["detail"]
+        statuses[detail] = statuses.get(detail, 0) + 1
+
+    buyer_after = await db.get_user_by_isu_id(buyer.isu_id)
+    reward_after = await db.get_reward_by_id(reward.id)
+    events = [event for event in await db.get_all_reward_events_for_user(buyer) if event.reward_id == reward.id]
+    expected = min(args.stock, args.affordable, args.purchases)
+
+    return {
+        "transactions": transactions,
+        "purchases": args.purchases,
+        "elapsed_s": round(elapsed, 3),
+        "throughput_rps": round(args.purchases / elapsed, 1),
+        "responses": statuses,
+        "expected_successes": expected,
+        "recorded_events": len(events),
+        "coins_left": buyer_after.coins,
+        "expected_coins_left": args.price * (args.affordable - expected),
+        "stock_left": reward_after.count,
+        "expected_stock_left": args.stock - expected,
+        "consistent": len(events) == expected
+        and buyer_after.coins == args.price * (args.affordable - expected)
+        and reward_after.count == args.stock - expected,
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", default="http://localhost:5000")
+    parser.add_argument("--purchases", type=int, default=200, help="number of concurrent checkout requests")
+    parser.add_argument("--stock", type=int, default=50, help="items of the reward in stock")
+    parser.add_argument("--affordable", type=int, default=80, help="purchases the buyer's balance covers")
+    parser.add_argument("--price", type=int, default=10)
+    parser.add_argument("--require-transactions", action="store_true", help="fail unless checkout runs in transactions")
+    args = parser.parse_args()
+
+    print(json.dumps(asyncio.get_event_loop().run_until_complete(run(args)), ensure_ascii=False, indent=2))
+
+
+if __name__ == "__main__":
+    main()
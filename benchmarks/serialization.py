@@ -0,0 +1,154 @@
+"""
+Per-request CPU spent turning stored data into the response body of /user/users and of a /chart/ page miss,
+before and after the trusted read path.
+
+Before: every document is validated by parse_obj_as, the response is validated against the response model
+once again, walked by jsonable_encoder and dumped with the stdlib json. After: models are constructed without
+validation and dumped with orjson. Both paths must produce the same document.
+
+    python -m benchmarks.serialization --users 2000 --rows 100 --runs 200
+"""
+import os
+
+os.environ.setdefault("MONGO_CONNECTION_URL", "mongodb://localhost:27017/?appname=benchmarks")
+
+import argparse
+import asyncio
+import json
+import random
+import time
+import typing as tp
+from datetime import datetime, timedelta
+
+import orjson
+from fastapi.responses import JSONResponse
+from fastapi.routing import serialize_response
+from pydantic import parse_obj_as
+
+from modules.routers import user_router  # routers go first, the rest of the modules import them
+from modules.database import MongoDbWrapper
+from modules.responses import FastJSONResponse
+from modules.routers.presentator.models import Chart, ChartEntry
+from modules.routers.user.models import User, UsersOut
+
+USERS_FIELD = next(route for route in user_router.routes if route.path == "/user/users").secure_cloned_response_field
+
+
+def _user_documents(count: int) -> tp.List[tp.Dict[str, tp.Any]]:
+    """documents the way motor returns them, password hash included"""
+    rng = random.Random(0)
+    started = datetime(2021, 9, 1)
+    return [
+        {
+            "name": f"Иванов Иван Иванович {number}",
+            "birth_date": started - timedelta(days=rng.randint(6000, 9000)),
+            "isu_id": str(100000 + number),
+            "date_created": started + timedelta(milliseconds=rng.randint(0, 10 ** 9)),
+            "permissions": ["read"],
+            "megafaculty": "МФ КТУ",
+            "is_teacher": False,
+            "faculty": "ФПИиКТ",
+            "program": "Программная инженерия",
+            "group": f"P31{number % 30:02}",
+            "points": rng.randint(0, 1000),
+            "coins": rng.randint(0, 100),
+            "hashed_password": "$2b$12$" + "x" * 53,
+        }
+        for number in range(count)
+    ]
+
+
+def _leaderboard_rows(count: int) -> tp.List[tp.Tuple[str, float]]:
+    """packed chart entries and scores the way the leaderboard returns them"""
+    rng = random.Random(0)
+    return [
+        (
+            json.dumps(
+                {
+                    "name": f"Иванов Иван Иванович {number}",
+                    "megafaculty": "МФ КТУ",
+                    "faculty": "ФПИиКТ",
+                    "program": "Программная инженерия",
+                    "group": "P3120",
+                }
+            ),
+            float(rng.randint(0, 1000)),
+        )
+        for number in range(count)
+    ]
+
+
+async def _users_before(documents: tp.List[tp.Dict[str, tp.Any]]) -> bytes:
+    users = [parse_obj_as(User, document) for document in documents]
+    content = await serialize_response(field=USERS_FIELD, response_content=UsersOut(users=users), is_coroutine=True)
+    return bytes(JSONResponse(content).body)
+
+
+async def _users_after(documents: tp.List[tp.Dict[str, tp.Any]]) -> bytes:
+    users = [MongoDbWrapper._load(User, document) for document in documents]
+    return bytes(FastJSONResponse(UsersOut.construct(users=users)).body)
+
+
+async def _chart_before(rows: tp.List[tp.Tuple[str, float]]) -> bytes:
+    chart_data = [
+        ChartEntry(**json.loads(entry), points=int(score), rating_position=position)
+        for position, (entry, score) in enumerate(rows, start=1)
+    ]
+    chart = Chart(detail=f"Success gathering chart of {len(chart_data)} rows", chart_data=chart_data, generated_at="")
+    return chart.json(ensure_ascii=False, separators=(",", ":")).encode()
+
+
+async def _chart_after(rows: tp.List[tp.Tuple[str, float]]) -> bytes:
+    chart_data = [
+        ChartEntry.construct(**json.loads(entry), points=int(score), rating_position=position)
+        for position, (entry, score) in enumerate(rows, start=1)
+    ]
+    chart = Chart.construct(
+        detail=f"Success gathering chart of {len(chart_data)} rows", chart_data=chart_data, generated_at=""
+    )
+    return orjson.dumps(chart.dict())
+
+
+async def _cpu_per_call(call: tp.Callable[[], tp.Awaitable[bytes]], runs: int) -> float:
+    started = time.process_time()
+    for _ in range(runs):
+        await call()
+    return (time.process_time() - started) / runs * 1e3
+
+
+async def run(args: argparse.Namespace) -> tp.Dict[str, tp.Any]:
+    documents = _user_documents(args.users)
+    rows = _leaderboard_rows(args.rows)
+    scenarios = {
+        "/user/users": (lambda: _users_before(documents), lambda: _users_after(documents)),
+        "/chart/ (miss)": (lambda: _chart_before(rows), lambda: _chart_after(rows)),
+    }
+
+    result: tp.Dict[str, tp.Any] = {"users": args.users, "rows": args.rows, "runs": args.runs, "cpu_ms": {}}
+    for name, (before, after) in scenarios.items():
+        if json.loads(await before()) != json.loads(await after()):
+            raise AssertionError(f"{name}: trusted path changed the response")
+
+        before_ms = await _cpu_per_call(before, args.runs)
+        after_ms = await _cpu_per_call(after, args.runs)
+        result["cpu_ms"][name] = {
+            "before": round(before_ms, 3),
+            "after": round(after_ms, 3),
+            "speedup": round(before_ms / after_ms, 2),
+        }
+
+    return result
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=2000)
+    parser.add_argument("--rows", type=int, default=100)
+    parser.add_argument("--runs", type=int, default=200)
+    args = parser.parse_args()
+
+    print(json.dumps(asyncio.run(run(args)), indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,116 @@
+from dotenv import load_dotenv
+
+load_dotenv()
+
+import argparse
+import asyncio
+from pathlib import Path
+
+from loguru import logger
+
+from modules import routers  # noqa: F401  # routers have to be initialized before the rest of the modules
+from modules.chart_cache import ChartCache
+from modules.database import MongoDbWrapper
+from modules.importer import IMPORT_BATCH_SIZE, IMPORT_FORMATS, detect_format, import_users
+from modules.leaderboard import LeaderboardEngine
+from modules.materializer import materialize_charts
+
+
+async def rebuild_leaderboard(_: argparse.Namespace) -> None:
+    """seed leaderboard sorted sets from the users collection"""
+    count = await LeaderboardEngine().rebuild()
+    await ChartCache().invalidate_all()
+    logger.info(f"leaderboard is ready, {count} students ranked")
+
+
+async def ensure_indexes(_: argparse.Namespace) -> None:
+    """create missing, recreate changed and drop undeclared collection indexes"""
+    await MongoDbWrapper().ensure_indexes(drop=True)
+
+
+async def check_query_plans(_: argparse.Namespace) -> None:
+    """fail if any of the database queries falls back to a collection scan"""
+    offenders = await MongoDbWrapper().check_query_plans()
+    if offenders:
+        raise SystemExit(f"queries without index support: {', '.join(offenders)}")
+    logger.info("all queries are index-backed")
+
+
+async def materialize(_: argparse.Namespace) -> None:
+    """compute the first page of every chart of the university structure and publish them to the chart cache"""
+    await materialize_charts()
+
+
+async def import_users_file(args: argparse.Namespace) -> None:
+    """create or update users from an NDJSON or CSV file"""
+    format_ = args.format or detect_format(args.path)
+    with open(args.path, encoding="utf-8", newline="") as lines:
+        async for progress in import_users(lines, format_, args.batch_size, args.skip):
+            for error in progress.errors:
+                logger.warning(f"row {error.row} ({error.isu_id}) rejected: {error.detail}")
+            logger.info(
+                f"{progress.rows} rows read, {progress.upserted} users created, "
+                f"{progress.modified} updated, {progress.failed} rejected"
+            )
+
+
+async def generate_dataset(args: argparse.Namespace) -> None:
+    """generate a reproducible synthetic dataset into NDJSON files or straight into the database"""
+    from modules.generator import DatasetGenerator, write_mongo, write_ndjson  # Faker is a dev dependency
+
+    generator = DatasetGenerator(
+        seed=args.seed,
+        students_per_group=args.students_per_group,
+        groups_per_program=args.groups_per_program,
+        achievements_per_student=args.achievements_per_student,
+        rewards_per_student=args.rewards_per_student,
+        teachers_per_faculty=args.teachers_per_faculty,
+        password=args.password,
+    )
+    logger.info(f"generating {generator.students_count} students")
+
+    if args.ndjson:
+        counts = write_ndjson(generator, Path(args.ndjson))
+    else:
+        counts = await write_mongo(generator, args.batch_size)
+        await rebuild_leaderboard(args)
+
+    logger.info(", ".join(f"{count} {collection}" for collection, count in counts.items()))
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="ITMOCHART management commands")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    commands.add_parser("rebuild-leaderboard", help=rebuild_leaderboard.__doc__).set_defaults(
+        handler=rebuild_leaderboard
+    )
+    commands.add_parser("ensure-indexes", help=ensure_indexes.__doc__).set_defaults(handler=ensure_indexes)
+    commands.add_parser("check-query-plans", help=check_query_plans.__doc__).set_defaults(handler=check_query_plans)
+    commands.add_parser("materialize-charts", help=materialize.__doc__).set_defaults(handler=materialize)
+
+    import_parser = commands.add_parser("import-users", help=import_users_file.__doc__)
+    import_parser.add_argument("path", help="NDJSON or CSV file with one user per row")
+    import_parser.add_argument("--format", choices=IMPORT_FORMATS, help="defaults to the file extension")
+    import_parser.add_argument("--batch-size", type=int, default=IMPORT_BATCH_SIZE)
+    import_parser.add_argument("--skip", type=int, default=0, help="resume after this many rows")
+    import_parser.set_defaults(handler=import_users_file)
+
+    generate_parser = commands.add_parser("generate-dataset", help=generate_dataset.__doc__)
+    generate_parser.add_argument("--seed", type=int, default=0)
+    generate_parser.add_argument("--students-per-group", type=int, default=15)
+    generate_parser.add_argument("--groups-per-program", type=int, default=1)
+    generate_parser.add_argument("--achievements-per-student", type=int, default=5, help="average, per student")
+    generate_parser.add_argument("--rewards-per-student", type=int, default=1, help="average purchase attempts")
+    generate_parser.add_argument("--teachers-per-faculty", type=int, default=2)
+    generate_parser.add_argument("--password", default="password", help="password of every generated user")
+    generate_parser.add_argument("--ndjson", metavar="DIRECTORY", help="write files instead of the database")
+    generate_parser.add_argument("--batch-size", type=int, default=IMPORT_BATCH_SIZE)
+    generate_parser.set_defaults(handler=generate_dataset)
+
+    args = parser.parse_args()
+    asyncio.get_event_loop().run_until_complete(args.handler(args))
+
+
+if __name__ == "__main__":
+    main()
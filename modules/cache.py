@@ -0,0 +1,73 @@
+import asyncio
+import os
+import time
+import typing as tp
+
+import redis.asyncio as aioredis
+from loguru import logger
+from redis.exceptions import RedisError
+
+from .metrics import REDIS_ERRORS, REDIS_SECONDS
+from .singleton import SingletonMeta
+
+T = tp.TypeVar("T")
+
+
+class AsyncCache(metaclass=SingletonMeta):
+    """Non-blocking Redis client backed by a bounded connection pool"""
+
+    def __init__(self) -> None:
+        """configure the pool from environment, connections are opened lazily"""
+        self.timeout: float = float(os.getenv("REDIS_OPERATION_TIMEOUT", 0.5))
+
+        pool = aioredis.BlockingConnectionPool(
+            host=os.getenv("REDIS_HOST", "redis"),
+            port=int(os.getenv("REDIS_PORT", 6379)),
+            max_connections=int(os.getenv("REDIS_POOL_SIZE", 32)),
+            timeout=self.timeout,
+            socket_connect_timeout=3,
+        )
+        self.client: aioredis.Redis = aioredis.Redis(connection_pool=pool)
+
+    async def run(self, operation: tp.Awaitable[T], name: str, timeout: tp.Optional[float] = None) -> T:
+        """await redis operation within the timeout, recording its round trip under the given name"""
+        started = time.perf_counter()
+        try:
+            return await asyncio.wait_for(operation, self.timeout if timeout is None else timeout)
+        except (asyncio.TimeoutError, RedisError):
+            REDIS_ERRORS.labels(name).inc()
+            raise
+        finally:
+            REDIS_SECONDS.labels(name).observe(time.perf_counter() - started)
+
+    async def call(self, operation: tp.Awaitable[T], default: T, name: str = "command") -> T:
+        """await redis operation within the timeout, return default if it fails"""
+        try:
+            return await self.run(operation, name)
+        except (asyncio.TimeoutError, RedisError) as e:
+            logger.warning(f"redis operation {name} failed: {e!r}")
+            return default
+
+    async def get(self, key: str) -> tp.Optional[bytes]:
+        """get cached value, None stands for a miss"""
+        return await self.call(self.client.get(key), default=None, name="get")
+
+    async def set(self, key: str, value: tp.Union[bytes, str], ttl: int) -> None:
+        """cache value for ttl seconds"""
+        await self.call(self.client.set(key, value, ex=ttl), default=None, name="set")
+
+    async def delete(self, *keys: str) -> None:
+        """evict given keys"""
+        if keys:
+            await self.call(self.client.delete(*keys), default=None, name="delete")
+
+    async def hget(self, key: str, field: str) -> tp.Optional[bytes]:
+        """get cached hash field, None stands for a miss"""
+        return await self.call(self.client.hget(key, field), default=None, name="hget")
+
+    async def hset(self, key: str, field: str, value: tp.Union[bytes, str], ttl: int) -> None:
+        """cache hash field, the whole hash expires ttl seconds after its last update"""
+        pipe = self.client.pipeline(transaction=False)
+        pipe.hset(key, field, value)
+        pipe.expire(key, ttl)
+        await self.call(pipe.execute(), default=None, name="hset")
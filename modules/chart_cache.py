@@ -0,0 +1,214 @@
+import asyncio
+import os
+import typing as tp
+
+import orjson
+from loguru import logger
+from redis.exceptions import RedisError, WatchError
+
+from .cache import AsyncCache
+from .local_cache import LocalCache
+from .metrics import CHART_CACHE_LOOKUPS
+from .routers.presentator.models import Chart, ChartPage, ChartScope
+from .routers.user.models import User
+from .singleton import SingletonMeta
+
+# bump whenever the cached payload changes, entries of other versions are never read and expire on their own
+CHART_CACHE_VERSION = 3
+# incremented whenever every chart is evicted, each scope also has its own generation under this prefix,
+# incremented whenever the scope's charts are evicted or replaced; both are kept apart from the chart keys
+GENERATION_KEY = f"chart-generation:v{CHART_CACHE_VERSION}"
+# retries of a conditional write whose watched generations changed, the other scopes may still be written
+_WRITE_RETRIES = 3
+
+# generation of the whole cache along with the generation of a single scope
+Generation = tp.Tuple[int, int]
+
+_LOCAL_HITS = CHART_CACHE_LOOKUPS.labels("local", "hit")
+_REDIS_HITS = CHART_CACHE_LOOKUPS.labels("redis", "hit")
+_MISSES = CHART_CACHE_LOOKUPS.labels("redis", "miss")
+_STALE_HITS = CHART_CACHE_LOOKUPS.labels("stale", "hit")
+_STALE_MISSES = CHART_CACHE_LOOKUPS.labels("stale", "miss")
+
+
+class ChartCache(metaclass=SingletonMeta):
+    """
+    Two-tier cache of fully serialized chart responses.
+    Pages of a scope are kept in a single Redis hash, so that they are evicted together.
+    """
+
+    def __init__(self) -> None:
+        self._cache = AsyncCache()
+        self._local = LocalCache(
+            "chart",
+            max_bytes=int(os.getenv("CHART_LOCAL_CACHE_BYTES", 32 * 1024 ** 2)),
+            ttl=float(os.getenv("CHART_LOCAL_CACHE_TTL", 60)),
+        )
+        # charts are evicted on every points change, so the ttl only bounds the lifetime of unused entries
+        self.ttl: int = int(os.getenv("CHART_CACHE_TTL", 24 * 60 ** 2))
+        # a stale copy outlives the chart and is served while the chart is recomputed
+        self.stale_while_revalidate: bool = os.getenv("CHART_STALE_WHILE_REVALIDATE", "0") == "1"
+        self.stale_ttl: int = int(os.getenv("CHART_STALE_TTL", 7 * 24 * 60 ** 2))
+
+    @staticmethod
+    def key(scope: ChartScope) -> str:
+        """redis key of the hash holding pages of the scope's chart"""
+        return f"chart:v{CHART_CACHE_VERSION}:{scope.key}"
+
+    @staticmethod
+    def field(page: ChartPage) -> str:
+        """hash field of the page"""
+        return f"{page.offset}:{page.limit}"
+
+    def _local_key(self, page: ChartPage) -> str:
+        return f"{self.key(page.scope)}#{self.field(page)}"
+
+    async def get(self, page: ChartPage) -> tp.Optional[bytes]:
+        """get serialized chart page, None if it is not cached"""
+        local_key = self._local_key(page)
+        body: tp.Optional[bytes] = self._local.get(local_key)
+
+        if body is not None:
+            _LOCAL_HITS.inc()
+            return body
+
+        body = await self._cache.hget(self.key(page.scope), self.field(page))
+        if body is not None:
+            _REDIS_HITS.inc()
+            self._local.set(local_key, body)
+        else:
+            _MISSES.inc()
+
+        return body
+
+    async def get_stale(self, page: ChartPage) -> tp.Optional[bytes]:
+        """get the last computed chart page, even if it has been evicted since"""
+        body: tp.Optional[bytes] = await self._cache.hget(f"{self.key(page.scope)}:stale", self.field(page))
+        (_STALE_HITS if body is not None else _STALE_MISSES).inc()
+        return body
+
+    async def put(self, page: ChartPage, chart: Chart, generation: Generation) -> bytes:
+        """
+        serialize the chart page once and cache the resulting response body.
+        nothing is cached if the scope was evicted since the generation was read, since the page may predate
+        the change; the body is returned either way
+        """
+        body = orjson.dumps(chart.dict())
+
+        try:
+            written = await self._write([(page, body)], {page.scope.key: generation}, replace=False)
+        except (asyncio.TimeoutError, RedisError) as e:
+            logger.warning(f"failed to cache chart {page.key}: {e!r}")
+            return body
+
+        if written:
+            self._local.set(self._local_key(page), body)
+        return body
+
+    @staticmethod
+    def _generation_key(scope_key: str) -> str:
+        return f"{GENERATION_KEY}:{scope_key}"
+
+    async def generations(self, *scopes: ChartScope) -> tp.Dict[str, Generation]:
+        """current generations of the scopes by scope key, they change whenever the scope's charts are evicted"""
+        keys = [GENERATION_KEY, *(self._generation_key(scope.key) for scope in scopes)]
+        values: tp.List[tp.Optional[bytes]] = await self._cache.call(
+            self._cache.client.mget(keys), default=[None] * len(keys), name="chart_generation"
+        )
+        epoch = int(values[0] or 0)
+        return {scope.key: (epoch, int(value or 0)) for scope, value in zip(scopes, values[1:])}
+
+    async def generation(self, scope: ChartScope) -> Generation:
+        """current generation of the scope"""
+        return (await self.generations(scope))[scope.key]
+
+    async def _evict(self, keys: tp.Collection[str], generation_keys: tp.Iterable[str]) -> None:
+        pipe = self._cache.client.pipeline(transaction=True)
+        if keys:
+            pipe.delete(*keys)
+        for generation_key in generation_keys:
+            pipe.incr(generation_key)
+        await self._cache.call(pipe.execute(), default=None, name="chart_evict")
+
+    async def invalidate(self, *scopes: ChartScope) -> None:
+        """evict every page of the given scopes"""
+        keys = {self.key(scope) for scope in scopes}
+        await self._evict(keys, {self._generation_key(scope.key) for scope in scopes})
+        await self._local.invalidate_prefix(*(f"{key}#" for key in keys))
+
+    async def invalidate_for(self, *users: User) -> None:
+        """evict every chart the users are ranked in"""
+        scopes = {scope.key: scope for user in users if not user.is_teacher for scope in ChartScope.covering(user)}
+        if scopes:
+            await self.invalidate(*scopes.values())
+
+    async def invalidate_all(self) -> None:
+        """evict charts of every scope"""
+        keys = [key async for key in self._cache.client.scan_iter(match=f"chart:v{CHART_CACHE_VERSION}:*")]
+        await self._evict(keys, [GENERATION_KEY])
+        await self._local.invalidate_all()
+
+    async def _write(
+        self, bodies: tp.List[tp.Tuple[ChartPage, bytes]], generations: tp.Dict[str, Generation], replace: bool
+    ) -> tp.Set[str]:
+        """
+        write the pages of the scopes still at the given generations in a single transaction, returns their keys.
+        with replace the previous pages of those scopes are dropped and their generations incremented
+        """
+        scope_keys = sorted({page.scope.key for page, _ in bodies})
+        watched = [GENERATION_KEY, *(self._generation_key(scope_key) for scope_key in scope_keys)]
+
+        for _ in range(_WRITE_RETRIES):
+            async with self._cache.client.pipeline(transaction=True) as pipe:
+                try:
+                    await self._cache.run(pipe.watch(*watched), "chart_generation_watch")
+                    values = await self._cache.run(pipe.mget(watched), "chart_generation")
+                    epoch = int(values[0] or 0)
+                    fresh = {
+                        scope_key
+                        for scope_key, value in zip(scope_keys, values[1:])
+                        if generations.get(scope_key) == (epoch, int(value or 0))
+                    }
+                    if not fresh:
+                        return fresh
+
+                    pipe.multi()
+                    for page, body in bodies:
+                        if page.scope.key not in fresh:
+                            continue
+                        key = self.key(page.scope)
+                        if replace:
+                            pipe.delete(key)
+                        pipe.hset(key, self.field(page), body)
+                        pipe.expire(key, self.ttl)
+                        if self.stale_while_revalidate:
+                            pipe.hset(f"{key}:stale", self.field(page), body)
+                            pipe.expire(f"{key}:stale", self.stale_ttl)
+                    if replace:
+                        for scope_key in fresh:
+                            pipe.incr(self._generation_key(scope_key))
+                    # a generation of every chart is a few hundred kilobytes, far more than a regular operation writes
+                    timeout = self._cache.timeout * (1 + len(pipe) // 100)
+                    await self._cache.run(pipe.execute(), "chart_write", timeout=timeout)
+                    return fresh
+                except WatchError:
+                    # some of the scopes were evicted meanwhile, the rest may still be written
+                    continue
+
+        return set()
+
+    async def put_generation(
+        self, charts: tp.List[tp.Tuple[ChartPage, Chart]], generations: tp.Dict[str, Generation]
+    ) -> tp.Set[str]:
+        """
+        replace the cached pages of the given scopes with the given pages in a single transaction.
+        scopes evicted since their generations were read are left out, since their pages may predate the change;
+        returns keys of the scopes whose pages were written
+        """
+        bodies = [(page, orjson.dumps(chart.dict())) for page, chart in charts]
+        written = await self._write(bodies, generations, replace=True)
+
+        await self._local.invalidate_prefix(
+            *(f"{self.key(page.scope)}#" for page, _ in bodies if page.scope.key in written)
+        )
+        return written
@@ -1,9 +1,18 @@
+import asyncio
 import os
 import typing as tp
 
-from motor.motor_asyncio import AsyncIOMotorClient, AsyncIOMotorCollection, AsyncIOMotorDatabase
+from motor.motor_asyncio import (
+    AsyncIOMotorClient,
+    AsyncIOMotorClientSession,
+    AsyncIOMotorCollection,
+    AsyncIOMotorDatabase,
+)
 from pydantic import BaseModel, parse_obj_as
+from pymongo import ReturnDocument, UpdateOne
+from pymongo.errors import BulkWriteError
 
+from .routers.presentator.models import ChartEntry, ChartScope, ScopeRank
 from .routers.service.models import (
     AchievementEvent,
     AchievementTemplate,
@@ -11,10 +20,33 @@ from .routers.service.models import (
     RewardEvent,
     Subject,
 )
+from .exceptions import InsufficientFundsError, OutOfStockError
+from .indexes import CHART_SCOPES, CHART_SORT, HISTORY_SORT, check_query_plans, ensure_indexes
+from .local_cache import LocalCache
+from .metrics import observe_queries
+from .models import HistoryPage
 from .routers.user.models import User, UserWithPassword
 from .singleton import SingletonMeta
 
 
+# documents of our own collections are validated on the way in, so reads build models without validating them again
+TRUSTED_READS = os.getenv("MONGO_TRUSTED_READS", "1") == "1"
+M = tp.TypeVar("M", bound=BaseModel)
+# balance increments of a bulk award in flight at once, bounds the connections a single award takes from the pool
+BALANCE_WRITE_CONCURRENCY = int(os.getenv("MONGO_BALANCE_WRITE_CONCURRENCY", 16))
+CHART_PROJECTION = {
+    "_id": 0,
+    "isu_id": 1,
+    "name": 1,
+    "megafaculty": 1,
+    "faculty": 1,
+    "program": 1,
+    "group": 1,
+    "points": 1,
+}
+
+
+@observe_queries
 class MongoDbWrapper(metaclass=SingletonMeta):
     """A database wrapper implementation for MongoDB"""
 
@@ -25,24 +57,39 @@ class MongoDbWrapper(metaclass=SingletonMeta):
         if mongo_connection_url is None:
             raise ValueError("MONGO_CONNECTION_URL environment variable not found")
 
-        mongo_client_url: str = str(mongo_connection_url) + "&ssl=true&tlsAllowInvalidCertificates=true"
+        mongo_client_url: str = str(mongo_connection_url)
+
+        # TLS is on by default for the hosted cluster, local and test deployments can turn it off
+        if os.getenv("MONGO_TLS", "1") == "1":
+            mongo_client_url += "&ssl=true&tlsAllowInvalidCertificates=true"
 
         if mongo_client_url is None:
             message = "Cannot establish database connection: $MONGO_CONNECTION_URL environment variable is not set."
             raise IOError(message)
 
-        mongo_client: AsyncIOMotorClient = AsyncIOMotorClient(mongo_client_url)
+        self._client: AsyncIOMotorClient = AsyncIOMotorClient(mongo_client_url)
 
-        self._database: AsyncIOMotorDatabase = mongo_client["itmochart"]
+        self._database: AsyncIOMotorDatabase = self._client["itmochart"]
         self._users_collection: AsyncIOMotorCollection = self._database["users"]
         self._subjects_collection: AsyncIOMotorCollection = self._database["subjects"]
         self._achievements_collection: AsyncIOMotorCollection = self._database["achievements"]
         self._achievement_events_collection: AsyncIOMotorCollection = self._database["achievement-events"]
         self._rewards_collection: AsyncIOMotorCollection = self._database["rewards"]
         self._reward_events_collection: AsyncIOMotorCollection = self._database["reward-events"]
+        # whether the server runs multi-document transactions, found out on the first checkout
+        self._transactions: tp.Optional[bool] = None
 
-    @staticmethod
+    async def ensure_indexes(self, drop: bool = False) -> None:
+        """create missing collection indexes, with drop also remove the ones the registry does not declare"""
+        await ensure_indexes(self._database, drop)
+
+    async def check_query_plans(self) -> tp.List[str]:
+        """get names of the queries which are not covered by any index"""
+        return await check_query_plans(self._database)
+
+    @classmethod
     async def _get_element_by_key(
+        cls,
         collection_: AsyncIOMotorCollection,
         key: str,
         value: str,
@@ -54,7 +101,14 @@ class MongoDbWrapper(metaclass=SingletonMeta):
         if not result:
             raise KeyError("Entry not found")
 
-        return parse_obj_as(model, result)
+        return cls._load(model, result)
+
+    @staticmethod
+    def _load(model_: tp.Type[M], document: tp.Dict[str, tp.Any]) -> M:
+        """model of a document read from our own collections, fields the model does not declare are dropped"""
+        if not TRUSTED_READS:
+            return parse_obj_as(model_, document)
+        return model_.construct(**{key: value for key, value in document.items() if key in model_.__fields__})
 
     @staticmethod
     async def _count_documents_in_collection(collection_: AsyncIOMotorCollection) -> int:
@@ -82,8 +136,9 @@ class MongoDbWrapper(metaclass=SingletonMeta):
     ) -> None:
         await collection_.find_one_and_update({key: value}, {"$set": new_data.dict(exclude=exclude)})
 
-    @staticmethod
+    @classmethod
     async def _get_all_from_collection(
+        cls,
         collection_: AsyncIOMotorCollection,
         model_: tp.Type[BaseModel],
         criteria: tp.Optional[tp.Dict[str, tp.Any]] = None,
@@ -92,11 +147,49 @@ class MongoDbWrapper(metaclass=SingletonMeta):
         return tp.cast(
             tp.List[BaseModel],
             [
-                parse_obj_as(model_, document)
+                cls._load(model_, document)
                 for document in await collection_.find(criteria or {}, {"_id": 0}).to_list(length=None)
             ],
         )
 
+    @staticmethod
+    def _history_criteria(page: HistoryPage) -> tp.Dict[str, tp.Any]:
+        """filter selecting events of the page's date range that come after the page's keyset position"""
+        timestamp: tp.Dict[str, tp.Any] = {}
+        if page.since is not None:
+            timestamp["$gte"] = page.since
+        if page.until is not None:
+            timestamp["$lt"] = page.until
+
+        criteria: tp.Dict[str, tp.Any] = {}
+        if page.after_timestamp is not None:
+            # the range keeps the index bounds tight, the $or only breaks ties between equal timestamps
+            timestamp["$lte"] = page.after_timestamp
+            criteria["$or"] = [{"timestamp": {"$lt": page.after_timestamp}}, {"id": {"$lt": page.after_id}}]
+
+        if timestamp:
+            criteria["timestamp"] = timestamp
+        return criteria
+
+    @classmethod
+    async def _get_page_from_collection(
+        cls,
+        collection_: AsyncIOMotorCollection,
+        model_: tp.Type[BaseModel],
+        criteria: tp.Dict[str, tp.Any],
+        page: HistoryPage,
+    ) -> tp.List[BaseModel]:
+        """
+        retrieves events of the page newest first, sorted and limited on the index.
+        one event over the limit is returned to tell whether there is a next page
+        """
+        cursor = (
+            collection_.find({**criteria, **cls._history_criteria(page)}, {"_id": 0})
+            .sort(HISTORY_SORT)
+            .limit(page.limit + 1)
+        )
+        return [cls._load(model_, document) async for document in cursor]
+
     @staticmethod
     async def _insert_document(collection: AsyncIOMotorCollection, model_: BaseModel) -> None:
         """insert document to the provided collection"""
@@ -106,13 +199,41 @@ class MongoDbWrapper(metaclass=SingletonMeta):
         """upload User to database"""
         return await self._insert_document(self._users_collection, user)
 
+    async def add_users(self, users: tp.List[UserWithPassword]) -> None:
+        """upload Users to database in a single batch"""
+        if users:
+            await self._users_collection.insert_many([user.dict() for user in users], ordered=False)
+
     async def get_user_by_isu_id(self, isu_id: str) -> UserWithPassword:
         """get user by its isu number from the DB and return it's model"""
         return await self._get_element_by_key(self._users_collection, "isu_id", isu_id, UserWithPassword)
 
-    async def get_all_users(self) -> tp.List[User]:
-        """get all available users"""
-        return await self._get_all_from_collection(self._users_collection, User)
+    async def get_all_users(self, criteria: tp.Optional[tp.Dict[str, tp.Any]] = None) -> tp.List[User]:
+        """get all available users, optionally only the matching ones"""
+        return await self._get_all_from_collection(self._users_collection, User, criteria)
+
+    async def iter_users(
+        self,
+        criteria: tp.Optional[tp.Dict[str, tp.Any]] = None,
+        fields: tp.Optional[tp.List[str]] = None,
+        batch_size: int = 500,
+    ) -> tp.AsyncIterator[tp.List[tp.Dict[str, tp.Any]]]:
+        """
+        iterate over raw user documents in batches of the cursor, so that only a single batch is held in memory.
+        documents are neither validated nor converted to models, password hashes are never returned
+        """
+        included = {field: 1 for field in fields or [] if field != "hashed_password"}
+        projection: tp.Dict[str, int] = {"_id": 0, **(included or {"hashed_password": 0})}
+
+        batch: tp.List[tp.Dict[str, tp.Any]] = []
+        async for document in self._users_collection.find(criteria or {}, projection, batch_size=batch_size):
+            batch.append(document)
+            if len(batch) >= batch_size:
+                yield batch
+                batch = []
+
+        if batch:
+            yield batch
 
     async def get_all_teachers(self) -> tp.List[User]:
         """get only teachers"""
@@ -154,13 +275,186 @@ class MongoDbWrapper(metaclass=SingletonMeta):
             {"is_teacher": False, "group": group},
         )
 
+    @staticmethod
+    def _chart_criteria(scope: ChartScope) -> tp.Dict[str, tp.Any]:
+        """filter selecting students ranked in the scope"""
+        criteria: tp.Dict[str, tp.Any] = {"is_teacher": False}
+        if scope.value is not None:
+            criteria[scope.kind] = scope.value
+        return criteria
+
+    @staticmethod
+    def _chart_entries(documents: tp.List[tp.Dict[str, tp.Any]], offset: int = 0) -> tp.List[ChartEntry]:
+        """chart rows out of user documents sorted by points"""
+        return [
+            ChartEntry.construct(
+                name=document["name"],
+                megafaculty=str(document.get("megafaculty")),
+                faculty=str(document.get("faculty")),
+                program=str(document.get("program")),
+                group=str(document.get("group")),
+                points=document.get("points", 0),
+                rating_position=position,
+            )
+            for position, document in enumerate(documents, start=offset + 1)
+        ]
+
+    async def get_chart(self, scope: ChartScope, limit: int = 100, offset: int = 0) -> tp.List[ChartEntry]:
+        """get students of the scope ordered by points, sorted and limited on the server side"""
+        cursor = (
+            self._users_collection.find(self._chart_criteria(scope), CHART_PROJECTION)
+            .sort(CHART_SORT)
+            .skip(offset)
+            .limit(limit)
+        )
+        return self._chart_entries(await cursor.to_list(length=limit), offset)
+
+    async def get_top_charts(
+        self, scopes: tp.List[ChartScope], limit: int = 100
+    ) -> tp.List[tp.Tuple[ChartScope, tp.List[ChartEntry], int]]:
+        """
+        get the top of every scope along with the number of students ranked in it, in a single pass over the users.
+        each scope is a $facet branch keeping only its top rows, scopes without students are left out
+        """
+        facets: tp.Dict[str, tp.List[tp.Dict[str, tp.Any]]] = {
+            f"top{index}": [
+                {"$match": {} if scope.value is None else {scope.kind: scope.value}},
+                {"$sort": dict(CHART_SORT)},
+                {"$limit": limit},
+            ]
+            for index, scope in enumerate(scopes)
+        }
+        facets["university"] = [{"$count": "count"}]
+        for kind in CHART_SCOPES:
+            facets[kind] = [{"$group": {"_id": f"${kind}", "count": {"$sum": 1}}}]
+
+        pipeline = [{"$match": {"is_teacher": False}}, {"$project": CHART_PROJECTION}, {"$facet": facets}]
+        [result] = await self._users_collection.aggregate(pipeline, allowDiskUse=True).to_list(length=1)
+
+        totals = {"university": sum(row["count"] for row in result["university"])}
+        for kind in CHART_SCOPES:
+            totals.update({f"{kind}:{row['_id']}": row["count"] for row in result[kind]})
+
+        return [
+            (scope, self._chart_entries(result[f"top{index}"]), totals[scope.key])
+            for index, scope in enumerate(scopes)
+            if result[f"top{index}"]
+        ]
+
+    async def count_chart(self, scope: ChartScope) -> int:
+        """count students ranked in the scope"""
+        count: int = await self._users_collection.count_documents(self._chart_criteria(scope))
+        return count
+
+    async def get_chart_ranks(self, user: User) -> tp.List[ScopeRank]:
+        """
+        get user's position in every scope they are ranked in, counting the students listed above them on the index.
+        students with equal points are listed by isu_id the way CHART_SORT orders them
+        """
+        scopes = ChartScope.covering(user)
+        above = {"$or": [{"points": {"$gt": user.points}}, {"points": user.points, "isu_id": {"$gt": user.isu_id}}]}
+
+        higher_counts = asyncio.gather(
+            *[self._users_collection.count_documents({**self._chart_criteria(scope), **above}) for scope in scopes]
+        )
+        totals = asyncio.gather(*[self.count_chart(scope) for scope in scopes])
+
+        return [
+            ScopeRank(kind=scope.kind, value=scope.value, rating_position=higher + 1, points=user.points, total=total)
+            for scope, higher, total in zip(scopes, await higher_counts, await totals)
+        ]
+
     async def update_user_data(self, user: User) -> None:
         """update user db entry with new data"""
         await self._update_document_in_collection(self._users_collection, "isu_id", user.isu_id, user)
+        await LocalCache.broadcast("principal", keys=[user.isu_id])
+
+    async def add_user_balance(self, isu_id: str, points: int = 0, coins: int = 0) -> User:
+        """atomically increment user's points and coins, returns the user with the new balance"""
+        document: tp.Optional[tp.Dict[str, tp.Any]] = await self._users_collection.find_one_and_update(
+            {"isu_id": isu_id},
+            {"$inc": {"points": points, "coins": coins}},
+            projection={"_id": 0, "hashed_password": 0},
+            return_document=ReturnDocument.AFTER,
+        )
+
+        if document is None:
+            raise KeyError("Entry not found")
+
+        await LocalCache.broadcast("principal", keys=[isu_id])
+        return self._load(User, document)
+
+    async def get_student_ids(self, scope: ChartScope) -> tp.List[str]:
+        """get isu ids of the students ranked in the scope"""
+        cursor = self._users_collection.find(self._chart_criteria(scope), {"_id": 0, "isu_id": 1})
+        return [document["isu_id"] async for document in cursor]
+
+    async def add_users_balance(
+        self, isu_ids: tp.List[str], points: int = 0, coins: int = 0
+    ) -> tp.Tuple[tp.List[User], tp.Dict[str, str]]:
+        """
+        atomically increment points and coins of every given user, at most BALANCE_WRITE_CONCURRENCY writes at a time.
+        returns the users found with the balance their own write left them, in the order of isu_ids,
+        along with the errors of the failed writes by isu_id; a failed write does not undo the others
+        """
+        semaphore = asyncio.Semaphore(BALANCE_WRITE_CONCURRENCY)
+
+        async def add_balance(isu_id: str) -> tp.Optional[tp.Dict[str, tp.Any]]:
+            async with semaphore:
+                document: tp.Optional[tp.Dict[str, tp.Any]] = await self._users_collection.find_one_and_update(
+                    {"isu_id": isu_id},
+                    {"$inc": {"points": points, "coins": coins}},
+                    projection={"_id": 0, "hashed_password": 0},
+                    return_document=ReturnDocument.AFTER,
+                )
+                return document
+
+        outcomes = await asyncio.gather(*[add_balance(isu_id) for isu_id in isu_ids], return_exceptions=True)
+
+        users: tp.List[User] = []
+        errors: tp.Dict[str, str] = {}
+        for isu_id, outcome in zip(isu_ids, outcomes):
+            if isinstance(outcome, Exception):
+                errors[isu_id] = str(outcome)
+            elif outcome is not None:
+                users.append(self._load(User, outcome))
+
+        if users:
+            await LocalCache.broadcast("principal", keys=[user.isu_id for user in users])
+        return users, errors
+
+    async def get_users_by_isu_ids(self, isu_ids: tp.List[str]) -> tp.List[User]:
+        """get users with the given isu numbers, unknown ones are skipped"""
+        return await self._get_all_from_collection(self._users_collection, User, {"isu_id": {"$in": isu_ids}})
+
+    async def upsert_users(self, users: tp.List[UserWithPassword]) -> tp.Dict[str, tp.Any]:
+        """
+        create or update users in a single unordered bulk write, existing users only get
+        the fields explicitly set on their models, so balances survive a repeated import.
+        returns the bulk write result along with the errors of the rejected operations
+        """
+        requests = []
+        for user in users:
+            update = {"$set": user.dict(exclude_unset=True)}
+            defaults = user.dict(exclude=user.__fields_set__)
+            if defaults:
+                update["$setOnInsert"] = defaults
+            requests.append(UpdateOne({"isu_id": user.isu_id}, update, upsert=True))
+
+        try:
+            write = await self._users_collection.bulk_write(requests, ordered=False)
+            result: tp.Dict[str, tp.Any] = write.bulk_api_result
+        except BulkWriteError as e:
+            result = e.details
+
+        if users:
+            await LocalCache.broadcast("principal", keys=[user.isu_id for user in users])
+        return result
 
     async def add_achievement(self, achievement: AchievementTemplate) -> None:
         """upload Achievement to database"""
-        return await self._insert_document(self._achievements_collection, achievement)
+        await self._insert_document(self._achievements_collection, achievement)
+        await LocalCache.broadcast("catalog", keys=["achievement-templates"])
 
     async def get_all_achievements(self) -> tp.List[AchievementTemplate]:
         """get all available achievement templates"""
@@ -176,6 +470,13 @@ class MongoDbWrapper(metaclass=SingletonMeta):
         """upload Achievement event to database"""
         return await self._insert_document(self._achievement_events_collection, achievement)
 
+    async def add_achievement_events(self, achievements: tp.List[AchievementEvent]) -> None:
+        """upload Achievement events to database in a single batch"""
+        if achievements:
+            await self._achievement_events_collection.insert_many(
+                [achievement.dict() for achievement in achievements], ordered=False
+            )
+
     async def get_all_recieved_achievements_for_user(self, user: User) -> tp.List[AchievementEvent]:
         """get all achievements recieved by the specified user"""
         return await self._get_all_from_collection(
@@ -188,6 +489,18 @@ class MongoDbWrapper(metaclass=SingletonMeta):
             self._achievement_events_collection, AchievementEvent, {"creator_id": user.isu_id}
         )
 
+    async def get_recieved_achievements_page(self, user: User, page: HistoryPage) -> tp.List[AchievementEvent]:
+        """get a page of achievements recieved by the user, newest first"""
+        return await self._get_page_from_collection(
+            self._achievement_events_collection, AchievementEvent, {"user_id": user.isu_id}, page
+        )
+
+    async def get_created_achievements_page(self, user: User, page: HistoryPage) -> tp.List[AchievementEvent]:
+        """get a page of achievements awarded by the user, newest first"""
+        return await self._get_page_from_collection(
+            self._achievement_events_collection, AchievementEvent, {"creator_id": user.isu_id}, page
+        )
+
     async def add_subject(self, subject: Subject) -> None:
         """upload subject to database"""
         return await self._insert_document(self._subjects_collection, subject)
@@ -198,7 +511,8 @@ class MongoDbWrapper(metaclass=SingletonMeta):
 
     async def add_reward(self, reward: Reward) -> None:
         """upload Reward to database"""
-        return await self._insert_document(self._rewards_collection, reward)
+        await self._insert_document(self._rewards_collection, reward)
+        await LocalCache.broadcast("catalog", keys=["rewards"])
 
     async def get_all_rewards(self) -> tp.List[Reward]:
         """get all available rewards"""
@@ -208,10 +522,86 @@ class MongoDbWrapper(metaclass=SingletonMeta):
         """get all available rewards"""
         return await self._get_element_by_key(self._rewards_collection, "id", reward_id, Reward)
 
+    async def _supports_transactions(self) -> bool:
+        """transactions need a replica set or a sharded cluster, a standalone server has none"""
+        if self._transactions is None:
+            hello: tp.Dict[str, tp.Any] = await self._client.admin.command("isMaster")
+            self._transactions = "setName" in hello or hello.get("msg") == "isdbgrid"
+        return self._transactions
+
+    async def _purchase(
+        self, isu_id: str, reward_id: str, session: tp.Optional[AsyncIOMotorClientSession] = None
+    ) -> RewardEvent:
+        """
+        take one item from stock, charge the user and record the purchase.
+        without a session the writes that already took place are undone by hand when a later one fails
+        """
+        reward: tp.Optional[tp.Dict[str, tp.Any]] = await self._rewards_collection.find_one_and_update(
+            {"id": reward_id, "count": {"$gt": 0}},
+            {"$inc": {"count": -1}},
+            projection={"_id": 0, "price": 1},
+            session=session,
+        )
+
+        if reward is None:
+            if await self._rewards_collection.count_documents({"id": reward_id}, session=session):
+                raise OutOfStockError("Reward is out of stock")
+            raise KeyError("Entry not found")
+
+        user = await self._users_collection.find_one_and_update(
+            {"isu_id": isu_id, "coins": {"$gte": reward["price"]}},
+            {"$inc": {"coins": -reward["price"]}},
+            projection={"_id": 1},
+            session=session,
+        )
+
+        if user is None:
+            if session is None:
+                await self._rewards_collection.update_one({"id": reward_id}, {"$inc": {"count": 1}})
+            raise InsufficientFundsError("Insufficient funds")
+
+        purchase_event = RewardEvent(reward_id=reward_id, user_id=isu_id)
+        try:
+            await self._reward_events_collection.insert_one(purchase_event.dict(), session=session)
+        except Exception:
+            if session is None:
+                await self._users_collection.update_one({"isu_id": isu_id}, {"$inc": {"coins": reward["price"]}})
+                await self._rewards_collection.update_one({"id": reward_id}, {"$inc": {"count": 1}})
+            raise
+
+        return purchase_event
+
+    async def checkout(self, isu_id: str, reward_id: str) -> RewardEvent:
+        """
+        charge the user for the reward, take one item from stock and record the purchase in a single transaction,
+        the conditional updates make concurrent purchases unable to overdraw the balance or the stock.
+        a standalone server has no transactions, there the same conditional updates run on their own
+        """
+        if await self._supports_transactions():
+            async with await self._client.start_session() as session:
+                # concurrent purchases of the same reward or by the same user abort each other with a write conflict,
+                # with_transaction runs the aborted ones again until they either succeed or fail on their own
+                purchase_event: RewardEvent = await session.with_transaction(
+                    lambda transaction: self._purchase(isu_id, reward_id, transaction)
+                )
+        else:
+            purchase_event = await self._purchase(isu_id, reward_id)
+
+        await LocalCache.broadcast("principal", keys=[isu_id])
+        await LocalCache.broadcast("catalog", keys=["rewards"])
+        return purchase_event
+
     async def add_reward_event(self, reward_event: RewardEvent) -> None:
         """upload reward-event to database"""
         return await self._insert_document(self._reward_events_collection, reward_event)
 
+    async def add_reward_events(self, reward_events: tp.List[RewardEvent]) -> None:
+        """upload Reward events to database in a single batch"""
+        if reward_events:
+            await self._reward_events_collection.insert_many(
+                [reward_event.dict() for reward_event in reward_events], ordered=False
+            )
+
     async def get_all_reward_events(self) -> tp.List[RewardEvent]:
         """get all available reward assignment events"""
         return await self._get_all_from_collection(self._reward_events_collection, RewardEvent)
@@ -221,3 +611,9 @@ class MongoDbWrapper(metaclass=SingletonMeta):
         return await self._get_all_from_collection(
             self._reward_events_collection, RewardEvent, {"user_id": user.isu_id}
         )
+
+    async def get_reward_events_page(self, user: User, page: HistoryPage) -> tp.List[RewardEvent]:
+        """get a page of purchases made by the user, newest first"""
+        return await self._get_page_from_collection(
+            self._reward_events_collection, RewardEvent, {"user_id": user.isu_id}, page
+        )
@@ -23,3 +23,26 @@ class CredentialsValidationException(HTTPException):
         self.headers = {"WWW-Authenticate": "Bearer"}
 
         logger.warning(f"{self.detail} : {kwargs}")
+
+
+class ServiceUnavailableException(HTTPException):
+    """Exception caused by a saturated resource, the client is expected to retry later"""
+
+    def __init__(self, details: tp.Optional[str] = None, retry_after: int = 1, **kwargs: tp.Any) -> None:
+        self.status_code = status.HTTP_503_SERVICE_UNAVAILABLE
+        self.detail = details or "Service is overloaded, try again later"
+        self.headers = {"Retry-After": str(retry_after)}
+
+        logger.warning(f"{self.detail} : {kwargs}")
+
+
+class InsufficientFundsError(Exception):
+    """User does not have enough coins for the purchase"""
+
+
+class OutOfStockError(Exception):
+    """No items of the reward are left"""
+
+
+class MaterializationConflictError(Exception):
+    """Charts kept changing while they were materialized"""
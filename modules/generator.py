@@ -0,0 +1,261 @@
+import math
+import random
+import typing as tp
+from datetime import datetime, timedelta
+from pathlib import Path
+from uuid import UUID
+
+from faker import Faker
+from passlib.hash import bcrypt
+
+from .database import MongoDbWrapper
+from .routers.service.models import AchievementEvent, AchievementTemplate, Reward, RewardEvent
+from .routers.user.models import UserWithPassword
+from .structure import university_structure
+from .utils import achievements, rewards
+
+DATASET_COLLECTIONS = ("users", "achievements", "achievement-events", "rewards", "reward-events")
+
+# bcrypt salt is fixed so that the same seed gives byte-identical output
+_PASSWORD_SALT = "itmochartdatasetsalt.u"
+_FIRST_ISU_ID = 100000
+_EPOCH = datetime(2021, 9, 1)
+
+
+class StudentRecord(tp.NamedTuple):
+    """a generated student along with the events that produced their balance"""
+
+    user: UserWithPassword
+    achievement_events: tp.List[AchievementEvent]
+    reward_events: tp.List[RewardEvent]
+
+
+class DatasetGenerator:
+    """
+    Synthetic university built from `university_structure`,
+    the same seed and settings always produce the same dataset
+    """
+
+    def __init__(
+        self,
+        seed: int = 0,
+        students_per_group: int = 15,
+        groups_per_program: int = 1,
+        achievements_per_student: int = 5,
+        rewards_per_student: int = 1,
+        teachers_per_faculty: int = 2,
+        password: str = "password",
+        name_pool_size: int = 500,
+    ) -> None:
+        self.seed = seed
+        self.students_per_group = students_per_group
+        self.groups_per_program = groups_per_program
+        self.achievements_per_student = achievements_per_student
+        self.rewards_per_student = rewards_per_student
+        self.teachers_per_faculty = teachers_per_faculty
+        self._hashed_password: str = bcrypt.using(salt=_PASSWORD_SALT, rounds=12).hash(password)
+
+        rng = self._random("catalog")
+        self.achievement_templates = [
+            AchievementTemplate(**{**template, "timestamp": _EPOCH, "id": self._uuid(rng)}) for template in achievements
+        ]
+        self.rewards = [Reward(**reward, count=10 ** 6, id=self._uuid(rng)) for reward in rewards]
+
+        # faker is slow per call, so names are drawn from pools generated once
+        faker = Faker(locale="ru_RU")
+        faker.seed_instance(seed)
+        self._names = {
+            gender: tuple(
+                [getattr(faker, f"{part}_{gender}")() for _ in range(name_pool_size)]
+                for part in ("last_name", "first_name", "middle_name")
+            )
+            for gender in ("male", "female")
+        }
+
+    def _random(self, section: str) -> random.Random:
+        """independent random stream per section, so sections do not shift each other"""
+        return random.Random(f"{self.seed}:{section}")
+
+    @staticmethod
+    def _uuid(rng: random.Random) -> str:
+        return UUID(int=rng.getrandbits(128), version=4).hex
+
+    def _name(self, rng: random.Random) -> str:
+        last, first, middle = self._names[rng.choice(("male", "female"))]
+        return f"{rng.choice(last)} {rng.choice(first)} {rng.choice(middle)}"
+
+    def groups(self) -> tp.Iterator[tp.Dict[str, str]]:
+        """scope of every group, programs with several groups get numbered group codes"""
+        for megafaculty, faculties in university_structure.items():
+            for faculty, programs in faculties.items():
+                for program, code in programs.items():
+                    for number in range(self.groups_per_program):
+                        yield {
+                            "megafaculty": megafaculty,
+                            "faculty": faculty,
+                            "program": program,
+                            "group": code if number == 0 else f"{code}-{number + 1}",
+                        }
+
+    @property
+    def students_count(self) -> int:
+        return sum(1 for _ in self.groups()) * self.students_per_group
+
+    def teachers(self) -> tp.List[UserWithPassword]:
+        """teachers of every faculty, they are the creators of the generated achievement events"""
+        rng = self._random("teachers")
+        teachers = []
+
+        for megafaculty, faculties in university_structure.items():
+            for faculty in faculties:
+                for _ in range(self.teachers_per_faculty):
+                    teachers.append(
+                        UserWithPassword.construct(
+                            name=self._name(rng),
+                            birth_date=datetime(1960, 1, 1) + timedelta(days=rng.randrange(365 * 30)),
+                            isu_id=f"{len(teachers) + 1:06d}",
+                            date_created=datetime(2010, 9, 1) + timedelta(days=rng.randrange(365 * 7)),
+                            permissions=["read", "write"],
+                            megafaculty=megafaculty,
+                            is_teacher=True,
+                            faculty=faculty,
+                            program=None,
+                            group=None,
+                            points=0,
+                            coins=0,
+                            hashed_password=self._hashed_password,
+                        )
+                    )
+
+        return teachers
+
+    def students(self) -> tp.Iterator[StudentRecord]:
+        """generate students group by group, their balances match the generated events"""
+        rng = self._random("students")
+        teachers: tp.Dict[str, tp.List[str]] = {}
+        for teacher in self.teachers():
+            teachers.setdefault(teacher.faculty, []).append(teacher.isu_id)
+
+        isu_id = _FIRST_ISU_ID
+        for context in self.groups():
+            creators = teachers.get(context["faculty"]) or ["000000"]
+
+            for _ in range(self.students_per_group):
+                isu_id += 1
+                date_created = datetime(2017, 9, 1) + timedelta(days=rng.randrange(365 * 4))
+                points = coins = 0
+
+                achievement_events = []
+                timestamp = max(date_created, _EPOCH)
+                for _ in range(rng.randint(0, 2 * self.achievements_per_student)):
+                    template = rng.choice(self.achievement_templates)
+                    timestamp += timedelta(seconds=rng.randrange(1, 30 * 86400))
+                    points += template.value
+                    coins += math.ceil(template.value * 0.2)
+                    achievement_events.append(
+                        AchievementEvent.construct(
+                            user_id=str(isu_id),
+                            creator_id=rng.choice(creators),
+                            achievement_id=template.id,
+                            estimated_income=template.value,
+                            balance_upon_receival=coins,
+                            timestamp=timestamp,
+                            id=self._uuid(rng),
+                        )
+                    )
+
+                reward_events = []
+                for _ in range(rng.randint(0, 2 * self.rewards_per_student)):
+                    reward = rng.choice(self.rewards)
+                    if reward.price > coins:
+                        continue
+                    timestamp += timedelta(seconds=rng.randrange(1, 30 * 86400))
+                    coins -= reward.price
+                    reward_events.append(
+                        RewardEvent.construct(
+                            reward_id=reward.id,
+                            user_id=str(isu_id),
+                            timestamp=timestamp,
+                            id=self._uuid(rng),
+                        )
+                    )
+
+                user = UserWithPassword.construct(
+                    name=self._name(rng),
+                    birth_date=datetime(1999, 1, 1) + timedelta(days=rng.randrange(365 * 5)),
+                    isu_id=str(isu_id),
+                    date_created=date_created,
+                    permissions=["read"],
+                    is_teacher=False,
+                    points=points,
+                    coins=coins,
+                    hashed_password=self._hashed_password,
+                    **context,
+                )
+                yield StudentRecord(user, achievement_events, reward_events)
+
+
+def write_ndjson(generator: DatasetGenerator, directory: Path) -> tp.Dict[str, int]:
+    """
+    write every collection to <directory>/<collection>.ndjson,
+    users.ndjson can be loaded with `manage.py import-users`
+    """
+    directory.mkdir(parents=True, exist_ok=True)
+    counts = dict.fromkeys(DATASET_COLLECTIONS, 0)
+    files = {name: open(directory / f"{name}.ndjson", "w", encoding="utf-8") for name in DATASET_COLLECTIONS}
+
+    def write(name: str, models: tp.Iterable[tp.Any]) -> None:
+        for model in models:
+            files[name].write(model.json(ensure_ascii=False) + "\n")
+            counts[name] += 1
+
+    try:
+        write("achievements", generator.achievement_templates)
+        write("rewards", generator.rewards)
+        write("users", generator.teachers())
+        for student in generator.students():
+            write("users", [student.user])
+            write("achievement-events", student.achievement_events)
+            write("reward-events", student.reward_events)
+    finally:
+        for file in files.values():
+            file.close()
+
+    return counts
+
+
+async def write_mongo(generator: DatasetGenerator, batch_size: int = 1000) -> tp.Dict[str, int]:
+    """insert the dataset into an empty database, batch by batch"""
+    db = MongoDbWrapper()
+    counts = dict.fromkeys(DATASET_COLLECTIONS, 0)
+
+    for template in generator.achievement_templates:
+        await db.add_achievement(template)
+    for reward in generator.rewards:
+        await db.add_reward(reward)
+    counts["achievements"], counts["rewards"] = len(generator.achievement_templates), len(generator.rewards)
+
+    users: tp.List[UserWithPassword] = generator.teachers()
+    achievement_events: tp.List[AchievementEvent] = []
+    reward_events: tp.List[RewardEvent] = []
+
+    async def flush() -> None:
+        await db.add_users(users)
+        await db.add_achievement_events(achievement_events)
+        await db.add_reward_events(reward_events)
+        counts["users"] += len(users)
+        counts["achievement-events"] += len(achievement_events)
+        counts["reward-events"] += len(reward_events)
+        users.clear()
+        achievement_events.clear()
+        reward_events.clear()
+
+    for student in generator.students():
+        users.append(student.user)
+        achievement_events.extend(student.achievement_events)
+        reward_events.extend(student.reward_events)
+        if len(users) >= batch_size or len(achievement_events) >= batch_size:
+            await flush()
+
+    await flush()
+    return counts
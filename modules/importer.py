@@ -0,0 +1,141 @@
+import codecs
+import csv
+import itertools
+import os
+import typing as tp
+
+from loguru import logger
+from pydantic import ValidationError
+from starlette.concurrency import run_in_threadpool
+
+from .chart_cache import ChartCache
+from .database import MongoDbWrapper
+from .leaderboard import LeaderboardEngine
+from .routers.user.models import ImportProgress, ImportRowError, User, UserWithPassword
+
+IMPORT_BATCH_SIZE = int(os.getenv("IMPORT_BATCH_SIZE", 1000))
+IMPORT_FORMATS = ("ndjson", "csv")
+
+# a row is either a raw NDJSON line or an already split CSV record
+Record = tp.Union[str, tp.Dict[str, tp.Any]]
+
+
+def detect_format(filename: str) -> str:
+    """guess the import format from the file extension, NDJSON unless it is a CSV file"""
+    return "csv" if filename.lower().endswith(".csv") else "ndjson"
+
+
+def decode_lines(stream: tp.IO[bytes], encoding: str = "utf-8") -> tp.Iterator[str]:
+    """lazily decode a binary stream line by line"""
+    return codecs.iterdecode(stream, encoding)
+
+
+def _read_ndjson(lines: tp.Iterable[str]) -> tp.Iterator[tp.Tuple[int, Record]]:
+    for row, line in enumerate(lines, start=1):
+        if line.strip():
+            yield row, line
+
+
+def _read_csv(lines: tp.Iterable[str]) -> tp.Iterator[tp.Tuple[int, Record]]:
+    """empty cells fall back to model defaults, permissions are separated with semicolons"""
+    reader = csv.DictReader(lines)
+    for record in reader:
+        fields = {key: value for key, value in record.items() if key and value not in ("", None)}
+        if "permissions" in fields:
+            fields["permissions"] = [permission.strip() for permission in fields["permissions"].split(";")]
+        yield reader.line_num, fields
+
+
+def _parse(row: int, record: Record) -> tp.Union[UserWithPassword, ImportRowError]:
+    try:
+        if isinstance(record, str):
+            return UserWithPassword.parse_raw(record)
+        return UserWithPassword.parse_obj(record)
+
+    except ValidationError as e:
+        isu_id = record.get("isu_id") if isinstance(record, dict) else None
+        detail = "; ".join(f"{'.'.join(map(str, error['loc']))}: {error['msg']}" for error in e.errors())
+        return ImportRowError(row=row, isu_id=isu_id, detail=detail)
+
+
+async def _import_batch(batch: tp.List[tp.Tuple[int, Record]], progress: ImportProgress) -> None:
+    """validate, upsert and rank one batch of rows, updating the progress in place"""
+    db, leaderboard = MongoDbWrapper(), LeaderboardEngine()
+    progress.rows = batch[-1][0]
+    progress.errors = []
+
+    # the last row wins if the batch mentions a student more than once
+    users: tp.Dict[str, UserWithPassword] = {}
+    rows: tp.Dict[str, int] = {}
+    for row, record in batch:
+        parsed = _parse(row, record)
+        if isinstance(parsed, ImportRowError):
+            progress.errors.append(parsed)
+            continue
+        users[parsed.isu_id] = parsed
+        rows[parsed.isu_id] = row
+
+    if users:
+        isu_ids = list(users)
+        previous = {user.isu_id: user for user in await db.get_users_by_isu_ids(isu_ids)}
+        result = await db.upsert_users(list(users.values()))
+        progress.upserted += result.get("nUpserted", 0)
+        progress.modified += result.get("nModified", 0)
+
+        rejected = set()
+        for error in result.get("writeErrors", []):
+            isu_id = isu_ids[error["index"]]
+            rejected.add(isu_id)
+            progress.errors.append(ImportRowError(row=rows[isu_id], isu_id=isu_id, detail=error["errmsg"]))
+
+        # the stored document is the previous one overwritten with the fields present in the file
+        current = [
+            User(**{**previous[isu_id].dict(), **user.dict(exclude_unset=True)}) if isu_id in previous else user
+            for isu_id, user in users.items()
+            if isu_id not in rejected
+        ]
+        try:
+            await leaderboard.replace_many(
+                [previous[user.isu_id] for user in current if user.isu_id in previous],
+                current,
+            )
+        except Exception as e:
+            logger.warning(f"failed to update leaderboard for imported students, rebuild required: {e}")
+
+    progress.errors.sort(key=lambda error: error.row)
+    progress.failed += len(progress.errors)
+
+
+async def import_users(
+    lines: tp.Iterable[str],
+    format_: str = "ndjson",
+    batch_size: int = IMPORT_BATCH_SIZE,
+    skip: int = 0,
+) -> tp.AsyncIterator[ImportProgress]:
+    """
+    stream users from NDJSON or CSV lines into the database, batch by batch,
+    yielding the progress after every batch. only one batch is held in memory,
+    the lines are read in a worker thread so that a blocking file does not stall the event loop.
+    rows up to `skip` are ignored, so an interrupted import is resumed from
+    the last reported row; repeating rows is harmless since users are upserted
+    """
+    if format_ not in IMPORT_FORMATS:
+        raise ValueError(f"Unsupported import format {format_}, expected one of {', '.join(IMPORT_FORMATS)}")
+
+    records = _read_csv(lines) if format_ == "csv" else _read_ndjson(lines)
+    records = itertools.dropwhile(lambda item: item[0] <= skip, records)
+    progress = ImportProgress(rows=skip)
+
+    while True:
+        batch = await run_in_threadpool(lambda: list(itertools.islice(records, batch_size)))
+        if not batch:
+            break
+        await _import_batch(batch, progress)
+        yield progress
+
+    if progress.upserted or progress.modified:
+        await ChartCache().invalidate_all()
+
+    progress.errors = []
+    progress.done = True
+    yield progress
@@ -0,0 +1,156 @@
+import typing as tp
+
+from loguru import logger
+from motor.motor_asyncio import AsyncIOMotorCollection, AsyncIOMotorDatabase
+from pymongo import ASCENDING, DESCENDING, IndexModel
+from pymongo.errors import OperationFailure
+
+CHART_SCOPES = ("megafaculty", "faculty", "program", "group")
+# event histories are paginated newest first, the id breaks ties between events of the same moment
+HISTORY_SORT = [("timestamp", DESCENDING), ("id", DESCENDING)]
+# charts are ranked by points, students with equal points are listed the way the leaderboard sorted sets list them
+CHART_SORT = [("points", DESCENDING), ("isu_id", DESCENDING)]
+# shape of the filter selecting students listed above a given one
+CHART_ABOVE = {"$or": [{"points": {"$gt": 0}}, {"points": 0, "isu_id": {"$gt": ""}}]}
+
+
+def _unique_id_index() -> IndexModel:
+    return IndexModel([("id", ASCENDING)], name="id_unique", unique=True)
+
+
+INDEXES: tp.Dict[str, tp.List[IndexModel]] = {
+    "users": [
+        IndexModel([("isu_id", ASCENDING)], name="isu_id_unique", unique=True),
+        IndexModel([("is_teacher", ASCENDING), *CHART_SORT], name="chart_university"),
+        *[
+            IndexModel([("is_teacher", ASCENDING), (scope, ASCENDING), *CHART_SORT], name=f"chart_{scope}")
+            for scope in CHART_SCOPES
+        ],
+    ],
+    "subjects": [_unique_id_index()],
+    "achievements": [_unique_id_index()],
+    "achievement-events": [
+        _unique_id_index(),
+        IndexModel([("user_id", ASCENDING), *HISTORY_SORT], name="user_id_timestamp"),
+        IndexModel([("creator_id", ASCENDING), *HISTORY_SORT], name="creator_id_timestamp"),
+    ],
+    "rewards": [_unique_id_index()],
+    "reward-events": [
+        _unique_id_index(),
+        IndexModel([("user_id", ASCENDING), *HISTORY_SORT], name="user_id_timestamp"),
+    ],
+}
+
+
+class QueryShape(tp.NamedTuple):
+    """a query issued by MongoDbWrapper, values are placeholders since only the shape matters for the plan"""
+
+    name: str
+    collection: str
+    criteria: tp.Dict[str, tp.Any]
+    sort: tp.Optional[tp.List[tp.Tuple[str, int]]] = None
+
+
+# full listings (get_all_users, get_all_rewards, etc.) are not filtered and scan their collections by design
+QUERY_SHAPES: tp.List[QueryShape] = [
+    QueryShape("get_user_by_isu_id", "users", {"isu_id": ""}),
+    QueryShape("get_all_teachers", "users", {"is_teacher": True}),
+    QueryShape("get_all_students", "users", {"is_teacher": False}),
+    *[QueryShape(f"get_all_students_by_{scope}", "users", {"is_teacher": False, scope: ""}) for scope in CHART_SCOPES],
+    QueryShape("get_chart[university]", "users", {"is_teacher": False}, CHART_SORT),
+    *[
+        QueryShape(f"get_chart[{scope}]", "users", {"is_teacher": False, scope: ""}, CHART_SORT)
+        for scope in CHART_SCOPES
+    ],
+    QueryShape("get_chart_ranks[university]", "users", {"is_teacher": False, **CHART_ABOVE}),
+    *[
+        QueryShape(f"get_chart_ranks[{scope}]", "users", {"is_teacher": False, scope: "", **CHART_ABOVE})
+        for scope in CHART_SCOPES
+    ],
+    QueryShape("get_achievement_template_by_id", "achievements", {"id": ""}),
+    QueryShape("get_all_recieved_achievements_for_user", "achievement-events", {"user_id": ""}),
+    QueryShape("get_all_created_achievements", "achievement-events", {"creator_id": ""}),
+    QueryShape("get_reward_by_id", "rewards", {"id": ""}),
+    QueryShape("get_all_reward_events_for_user", "reward-events", {"user_id": ""}),
+    *[
+        QueryShape(f"{name}[{position}]", collection, {key: "", **criteria}, HISTORY_SORT)
+        for name, collection, key in (
+            ("get_recieved_achievements_page", "achievement-events", "user_id"),
+            ("get_created_achievements_page", "achievement-events", "creator_id"),
+            ("get_reward_events_page", "reward-events", "user_id"),
+        )
+        for position, criteria in (
+            ("first", {}),
+            ("next", {"timestamp": {"$lte": 0}, "$or": [{"timestamp": {"$lt": 0}}, {"id": {"$lt": ""}}]}),
+        )
+    ],
+]
+
+
+async def _drop_index(collection: AsyncIOMotorCollection, name: str) -> None:
+    """drop an index, tolerating another replica having dropped it first"""
+    try:
+        await collection.drop_index(name)
+    except OperationFailure as e:
+        logger.warning(f"failed to drop index {collection.name}.{name}: {e}")
+
+
+async def ensure_indexes(database: AsyncIOMotorDatabase, drop: bool = False) -> None:
+    """
+    create the declared indexes missing from every collection.
+    with drop undeclared indexes are dropped and changed ones recreated, otherwise they are only reported
+    """
+    for collection_name, indexes in INDEXES.items():
+        collection = database[collection_name]
+        existing: tp.Dict[str, tp.Dict[str, tp.Any]] = await collection.index_information()
+        declared = {index.document["name"]: index for index in indexes}
+
+        for name in set(existing) - set(declared) - {"_id_"} if drop else ():
+            logger.info(f"dropping undeclared index {collection_name}.{name}")
+            await _drop_index(collection, name)
+
+        for name, index in declared.items():
+            current = existing.get(name)
+            if current is not None:
+                if list(current["key"]) == list(index.document["key"].items()) and bool(
+                    current.get("unique")
+                ) == bool(index.document.get("unique")):
+                    continue
+                if not drop:
+                    logger.warning(f"index {collection_name}.{name} differs from the registry, run ensure-indexes")
+                    continue
+                logger.info(f"recreating changed index {collection_name}.{name}")
+                await _drop_index(collection, name)
+
+            try:
+                await collection.create_indexes([index])
+                logger.info(f"created index {collection_name}.{name}")
+            except OperationFailure as e:
+                logger.error(f"failed to create index {collection_name}.{name}: {e}")
+
+
+def _has_collection_scan(plan: tp.Any) -> bool:
+    """walk the explain output looking for a COLLSCAN stage"""
+    if isinstance(plan, dict):
+        return plan.get("stage") == "COLLSCAN" or any(_has_collection_scan(value) for value in plan.values())
+    if isinstance(plan, list):
+        return any(_has_collection_scan(value) for value in plan)
+    return False
+
+
+async def check_query_plans(database: AsyncIOMotorDatabase) -> tp.List[str]:
+    """explain every known wrapper query and return names of those falling back to a collection scan"""
+    offenders = []
+
+    for shape in QUERY_SHAPES:
+        cursor = database[shape.collection].find(shape.criteria)
+        if shape.sort:
+            cursor = cursor.sort(shape.sort)
+
+        explanation: tp.Dict[str, tp.Any] = await cursor.explain()
+
+        if _has_collection_scan(explanation["queryPlanner"]["winningPlan"]):
+            logger.warning(f"{shape.name} falls back to COLLSCAN on {shape.collection}")
+            offenders.append(shape.name)
+
+    return offenders
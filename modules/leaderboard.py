@@ -0,0 +1,175 @@
+import json
+import typing as tp
+
+from loguru import logger
+
+from .cache import AsyncCache
+from .routers.presentator.models import ChartEntry, ChartScope, ScopeRank
+from .routers.user.models import User
+from .database import MongoDbWrapper
+from .singleton import SingletonMeta
+
+
+class LeaderboardEngine(metaclass=SingletonMeta):
+    """Student rankings kept in Redis sorted sets, one set per chart scope"""
+
+    _prefix = "leaderboard"
+    _entries_key = f"{_prefix}:entries"
+    _ready_key = f"{_prefix}:ready"
+    _rebuild_prefix = f"{_prefix}-rebuild"
+    _rebuild_fields = ["isu_id", "name", "megafaculty", "faculty", "program", "group", "points"]
+
+    def __init__(self) -> None:
+        self._cache = AsyncCache()
+        self._redis = self._cache.client
+
+    def _scope_key(self, scope: ChartScope) -> str:
+        """sorted set name for the given scope"""
+        return f"{self._prefix}:{scope.key}"
+
+    @staticmethod
+    def _pack_entry(student: User) -> str:
+        """static part of the student's chart row, stored once per student"""
+        return json.dumps(
+            {
+                "name": student.name,
+                "megafaculty": str(student.megafaculty),
+                "faculty": str(student.faculty),
+                "program": str(student.program),
+                "group": str(student.group),
+            }
+        )
+
+    async def is_ready(self) -> bool:
+        """check if the sorted sets have been seeded and can be served"""
+        return bool(await self._cache.call(self._redis.exists(self._ready_key), default=0, name="leaderboard_ready"))
+
+    async def add_points(self, student: User, points: int) -> None:
+        """increment student's score in every scope they are ranked in"""
+        await self.add_points_many([student], points)
+
+    async def add_points_many(self, students: tp.List[User], points: int) -> None:
+        """increment score of every student in the scopes they are ranked in, in a single round trip"""
+        pipe = self._redis.pipeline(transaction=False)
+
+        for student in students:
+            if student.is_teacher:
+                continue
+            pipe.hset(self._entries_key, student.isu_id, self._pack_entry(student))
+            for scope in ChartScope.covering(student):
+                pipe.zincrby(self._scope_key(scope), points, student.isu_id)
+
+        if len(pipe):
+            # large batches get the operation timeout per every thousand commands
+            await self._cache.run(pipe.execute(), "leaderboard_add", self._cache.timeout * (1 + len(pipe) // 1000))
+
+    async def replace_many(self, previous: tp.List[User], current: tp.List[User]) -> None:
+        """
+        move students from their previous scopes and scores to the current ones in a single round trip,
+        students turned into teachers leave the charts
+        """
+        pipe = self._redis.pipeline(transaction=False)
+
+        for student in previous:
+            if not student.is_teacher:
+                for scope in ChartScope.covering(student):
+                    pipe.zrem(self._scope_key(scope), student.isu_id)
+                pipe.hdel(self._entries_key, student.isu_id)
+
+        for student in current:
+            if student.is_teacher:
+                continue
+            pipe.hset(self._entries_key, student.isu_id, self._pack_entry(student))
+            for scope in ChartScope.covering(student):
+                pipe.zadd(self._scope_key(scope), {student.isu_id: student.points})
+
+        if len(pipe):
+            await self._cache.run(pipe.execute(), "leaderboard_replace", self._cache.timeout * (1 + len(pipe) // 1000))
+
+    async def top(self, scope: ChartScope, limit: int = 100, offset: int = 0) -> tp.List[ChartEntry]:
+        """get chart rows of the scope ordered by points, starting at the given offset"""
+        members: tp.List[tp.Tuple[bytes, float]] = await self._cache.run(
+            self._redis.zrevrange(self._scope_key(scope), offset, offset + limit - 1, withscores=True),
+            "leaderboard_top",
+        )
+
+        if not members:
+            return []
+
+        entries = await self._cache.run(
+            self._redis.hmget(self._entries_key, [member for member, _ in members]),
+            "leaderboard_entries",
+        )
+
+        return [
+            ChartEntry.construct(**json.loads(entry), points=int(score), rating_position=position)
+            for position, ((_, score), entry) in enumerate(zip(members, entries), start=offset + 1)
+            if entry is not None
+        ]
+
+    async def ranks(self, student: User) -> tp.List[ScopeRank]:
+        """
+        get student's position in every scope they are ranked in, in a single round trip.
+        the position is the one the student is listed at in the chart: students with equal points are ordered
+        by isu_id descending, the way ZREVRANGE lists equal scores and the database fallback sorts them
+        """
+        scopes = ChartScope.covering(student)
+
+        pipe = self._redis.pipeline(transaction=False)
+        for scope in scopes:
+            pipe.zrevrank(self._scope_key(scope), student.isu_id)
+            pipe.zcard(self._scope_key(scope))
+        results = await self._cache.run(pipe.execute(), "leaderboard_ranks")
+
+        return [
+            ScopeRank(
+                kind=scope.kind,
+                value=scope.value,
+                rating_position=None if rank is None else rank + 1,
+                points=student.points,
+                total=total,
+            )
+            for scope, rank, total in zip(scopes, results[0::2], results[1::2])
+        ]
+
+    async def count(self, scope: ChartScope) -> int:
+        """get number of students ranked in the scope"""
+        return int(await self._cache.run(self._redis.zcard(self._scope_key(scope)), "leaderboard_count"))
+
+    async def rebuild(self, batch_size: int = 1000) -> int:
+        """
+        seed the sorted sets from the users collection, replacing their previous state.
+        students are streamed into temporary keys a batch at a time, the temporary keys then replace
+        the live ones in a single transaction, so neither the process nor Redis ever hold more than a batch
+        """
+        leftovers = [key async for key in self._redis.scan_iter(match=f"{self._rebuild_prefix}:*")]
+        if leftovers:
+            await self._cache.run(self._redis.unlink(*leftovers), "leaderboard_rebuild")
+
+        scopes: tp.Set[str] = set()
+        count = 0
+        async for documents in MongoDbWrapper().iter_users({"is_teacher": False}, self._rebuild_fields, batch_size):
+            pipe = self._redis.pipeline(transaction=False)
+            for document in documents:
+                student = User.construct(**document)
+                pipe.hset(f"{self._rebuild_prefix}:entries", student.isu_id, self._pack_entry(student))
+                for scope in ChartScope.covering(student):
+                    pipe.zadd(f"{self._rebuild_prefix}:{scope.key}", {student.isu_id: student.points})
+                    scopes.add(scope.key)
+            await self._cache.run(pipe.execute(), "leaderboard_rebuild", self._cache.timeout * (1 + len(pipe) // 1000))
+            count += len(documents)
+
+        live = [key async for key in self._redis.scan_iter(match=f"{self._prefix}:*")]
+        pipe = self._redis.pipeline(transaction=True)
+        if live:
+            # unlink frees the previous sets in the background instead of blocking the transaction
+            pipe.unlink(*live)
+        if count:
+            pipe.rename(f"{self._rebuild_prefix}:entries", self._entries_key)
+        for key in scopes:
+            pipe.rename(f"{self._rebuild_prefix}:{key}", f"{self._prefix}:{key}")
+        pipe.set(self._ready_key, 1)
+        await self._cache.run(pipe.execute(), "leaderboard_swap", self._cache.timeout * (1 + len(pipe) // 1000))
+
+        logger.info(f"leaderboard rebuilt from {count} students")
+        return count
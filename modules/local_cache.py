@@ -0,0 +1,166 @@
+import asyncio
+import json
+import sys
+import time
+import typing as tp
+from collections import OrderedDict
+
+from loguru import logger
+from redis.exceptions import RedisError
+
+from .cache import AsyncCache
+
+INVALIDATION_CHANNEL = "local-cache-invalidation"
+
+
+class LocalCache:
+    """
+    Bounded in-process LRU cache with per-entry TTL, kept in front of Redis and MongoDB.
+    Caches are registered by name, so that invalidations published by one worker reach the same cache in the others.
+    """
+
+    _registry: tp.Dict[str, "LocalCache"] = {}
+
+    def __init__(self, name: str, max_bytes: int, ttl: float) -> None:
+        self.name = name
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._size = 0
+        self._entries: "OrderedDict[str, tp.Tuple[float, int, tp.Any]]" = OrderedDict()
+        self._registry[name] = self
+
+    @staticmethod
+    def _size_of(value: tp.Any) -> int:
+        return len(value) if isinstance(value, (bytes, str)) else sys.getsizeof(value)
+
+    def get(self, key: str) -> tp.Optional[tp.Any]:
+        """get value if it is cached and not expired"""
+        entry = self._entries.get(key)
+
+        if entry is None or entry[0] < time.monotonic():
+            if entry is not None:
+                self._drop(key)
+            self.misses += 1
+            return None
+
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[2]
+
+    def set(
+        self,
+        key: str,
+        value: tp.Any,
+        ttl: tp.Optional[float] = None,
+        size: tp.Optional[int] = None,
+    ) -> None:
+        """cache value, evicting least recently used entries to stay within the size limit"""
+        size = self._size_of(value) if size is None else size
+        if size > self.max_bytes:
+            return
+
+        self._drop(key)
+        self._entries[key] = (time.monotonic() + (self.ttl if ttl is None else ttl), size, value)
+        self._size += size
+
+        while self._size > self.max_bytes:
+            oldest = next(iter(self._entries))
+            self._drop(oldest)
+            self.evictions += 1
+
+    def _drop(self, key: str) -> None:
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._size -= entry[1]
+
+    def discard(self, *keys: str) -> None:
+        """drop given keys in this process only"""
+        for key in keys:
+            self._drop(key)
+
+    def discard_prefix(self, *prefixes: str) -> None:
+        """drop keys starting with any of the given prefixes in this process only"""
+        for key in [key for key in self._entries if key.startswith(prefixes)]:
+            self._drop(key)
+
+    def clear(self) -> None:
+        """drop every entry in this process only"""
+        self._entries.clear()
+        self._size = 0
+
+    @property
+    def hit_rate(self) -> float:
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def stats(self) -> tp.Dict[str, tp.Union[int, float]]:
+        return {
+            "hit_rate": self.hit_rate,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "entries": len(self._entries),
+            "bytes": self._size,
+        }
+
+    async def invalidate(self, *keys: str) -> None:
+        """drop given keys in every worker"""
+        if not keys:
+            return
+        await self.broadcast(self.name, keys=keys)
+
+    async def invalidate_prefix(self, *prefixes: str) -> None:
+        """drop keys starting with any of the given prefixes in every worker"""
+        if not prefixes:
+            return
+        await self.broadcast(self.name, prefixes=prefixes)
+
+    async def invalidate_all(self) -> None:
+        """drop every entry in every worker"""
+        await self.broadcast(self.name)
+
+    @classmethod
+    async def broadcast(cls, name: str, keys: tp.Sequence[str] = (), prefixes: tp.Sequence[str] = ()) -> None:
+        """invalidate the named cache here and in the other workers, no keys and prefixes stand for the whole cache"""
+        message = json.dumps({"cache": name, "keys": list(keys), "prefixes": list(prefixes)})
+        cls._apply(message)
+        cache = AsyncCache()
+        await cache.call(cache.client.publish(INVALIDATION_CHANNEL, message), default=None, name="publish")
+
+    @classmethod
+    def _apply(cls, raw_message: tp.Union[bytes, str]) -> None:
+        message = json.loads(raw_message)
+        cache = cls._registry.get(message["cache"])
+
+        if cache is None:
+            return
+
+        if not message["keys"] and not message["prefixes"]:
+            cache.clear()
+        else:
+            cache.discard(*message["keys"])
+            cache.discard_prefix(*message["prefixes"])
+
+    @classmethod
+    async def listen(cls) -> None:
+        """apply invalidations published by all workers, runs for the lifetime of the app"""
+        while True:
+            pubsub = AsyncCache().client.pubsub(ignore_subscribe_messages=True)
+            try:
+                await pubsub.subscribe(INVALIDATION_CHANNEL)
+                # invalidations published while unsubscribed are lost, start over with empty caches
+                for cache in cls._registry.values():
+                    cache.clear()
+
+                async for message in pubsub.listen():
+                    cls._apply(message["data"])
+
+            except (RedisError, OSError) as e:
+                logger.warning(f"local cache invalidation listener failed, resubscribing: {e!r}")
+                await asyncio.sleep(1)
+
+            finally:
+                await pubsub.reset()
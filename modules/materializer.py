@@ -0,0 +1,93 @@
+import asyncio
+import os
+import typing as tp
+
+from fastapi import status
+from loguru import logger
+
+from .cache import AsyncCache
+from .chart_cache import ChartCache
+from .database import MongoDbWrapper
+from .exceptions import MaterializationConflictError
+from .routers.presentator.dependencies import CHART_PAGE_LIMIT
+from .routers.presentator.models import Chart, ChartPage, ChartScope
+from .structure import university_structure
+
+# seconds between two materializations of every chart, 0 turns the schedule off
+CHART_MATERIALIZE_INTERVAL = float(os.getenv("CHART_MATERIALIZE_INTERVAL", 300))
+CHART_MATERIALIZE_RETRIES = int(os.getenv("CHART_MATERIALIZE_RETRIES", 3))
+
+_TURN_KEY = "chart-materializer:turn"
+
+
+def structure_scopes() -> tp.List[ChartScope]:
+    """the whole university and every unit of its structure"""
+    scopes = [ChartScope()]
+    for megafaculty, faculties in university_structure.items():
+        scopes.append(ChartScope(kind="megafaculty", value=megafaculty))
+        for faculty, programs in faculties.items():
+            scopes.append(ChartScope(kind="faculty", value=faculty))
+            for program, group in programs.items():
+                scopes.append(ChartScope(kind="program", value=program))
+                scopes.append(ChartScope(kind="group", value=group))
+    return scopes
+
+
+async def materialize_charts() -> int:
+    """
+    compute the first page of every scope in a single aggregation and publish the pages as a new chart generation.
+    scopes evicted meanwhile are aggregated once again, returns the number of published charts
+    """
+    chart_cache = ChartCache()
+    scopes = structure_scopes()
+    published = 0
+
+    for attempt in range(1, CHART_MATERIALIZE_RETRIES + 1):
+        generations = await chart_cache.generations(*scopes)
+        charts = [
+            (
+                ChartPage(scope=scope, offset=0, limit=CHART_PAGE_LIMIT),
+                # rows come from our own collection
+                Chart.construct(
+                    status_code=status.HTTP_200_OK,
+                    detail=f"Success gathering chart of {len(chart_data)} rows",
+                    chart_data=chart_data,
+                    offset=0,
+                    total=total,
+                ),
+            )
+            for scope, chart_data, total in await MongoDbWrapper().get_top_charts(scopes, limit=CHART_PAGE_LIMIT)
+        ]
+
+        written = await chart_cache.put_generation(charts, generations)
+        published += len(written)
+        # scopes without students have nothing to publish
+        scopes = [page.scope for page, _ in charts if page.scope.key not in written]
+        if not scopes:
+            logger.info(f"materialized {published} charts")
+            return published
+
+        logger.warning(
+            f"{len(scopes)} charts changed while being materialized, attempt {attempt} of {CHART_MATERIALIZE_RETRIES}"
+        )
+
+    if not published:
+        raise MaterializationConflictError(f"Charts changed during each of {CHART_MATERIALIZE_RETRIES} attempts")
+
+    logger.info(f"materialized {published} charts, {len(scopes)} are left to be computed on demand")
+    return published
+
+
+async def materialize_periodically(interval: float) -> None:
+    """materialize the charts every interval seconds, each time a single worker of the deployment does it"""
+    cache = AsyncCache()
+
+    while True:
+        try:
+            turn = cache.client.set(_TURN_KEY, 1, nx=True, ex=max(int(interval), 1))
+            if await cache.call(turn, default=None, name="chart_materializer_turn"):
+                await materialize_charts()
+        except Exception as e:
+            logger.error(f"chart materialization failed: {e!r}")
+
+        await asyncio.sleep(interval)
@@ -0,0 +1,159 @@
+import functools
+import inspect
+import time
+import typing as tp
+
+from prometheus_client import REGISTRY, Counter, Gauge, Histogram
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+T = tp.TypeVar("T")
+
+# most of the hot paths finish within milliseconds, the tail goes up to bcrypt and chart computations
+_LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+REQUEST_SECONDS = Histogram(
+    "http_request_duration_seconds",
+    "Time spent handling a request, until the last byte of the response",
+    ["method", "route", "status"],
+    buckets=_LATENCY_BUCKETS,
+)
+MONGO_QUERY_SECONDS = Histogram(
+    "mongodb_query_duration_seconds",
+    "Time spent in a MongoDbWrapper method",
+    ["method"],
+    buckets=_LATENCY_BUCKETS,
+)
+MONGO_QUERY_ERRORS = Counter("mongodb_query_errors_total", "Failed MongoDbWrapper calls", ["method"])
+MONGO_DOCUMENTS = Counter("mongodb_documents_returned_total", "Documents returned by MongoDbWrapper", ["method"])
+REDIS_SECONDS = Histogram(
+    "redis_operation_duration_seconds",
+    "Redis round trip time, commands and pipelines",
+    ["operation"],
+    buckets=_LATENCY_BUCKETS,
+)
+REDIS_ERRORS = Counter("redis_operation_errors_total", "Redis operations failed or timed out", ["operation"])
+CHART_CACHE_LOOKUPS = Counter("chart_cache_lookups_total", "Chart cache lookups by tier", ["tier", "result"])
+CHART_COMPUTE_SECONDS = Histogram(
+    "chart_compute_duration_seconds",
+    "Time spent building and caching a chart page on a cache miss",
+    buckets=_LATENCY_BUCKETS,
+)
+PASSWORD_HASHER_QUEUE_DEPTH = Gauge("password_hasher_queue_depth", "bcrypt calls waiting for a free worker")
+PASSWORD_HASHER_PENDING = Gauge("password_hasher_pending", "bcrypt calls running or waiting")
+
+
+class LocalCacheCollector:
+    """exposes statistics of every in-process cache, read at scrape time"""
+
+    def describe(self) -> tp.List[tp.Any]:
+        """collect imports the caches lazily, so nothing is described at registration"""
+        return []
+
+    def collect(self) -> tp.Iterator[tp.Union[CounterMetricFamily, GaugeMetricFamily]]:
+        from .local_cache import LocalCache  # local caches depend on Redis, which is instrumented here
+
+        lookups = CounterMetricFamily("local_cache_lookups", "Local cache lookups", labels=["cache", "result"])
+        evictions = CounterMetricFamily("local_cache_evictions", "Entries evicted to fit the size", labels=["cache"])
+        entries = GaugeMetricFamily("local_cache_entries", "Entries held by the local cache", labels=["cache"])
+        size = GaugeMetricFamily("local_cache_bytes", "Bytes held by the local cache", labels=["cache"])
+
+        for name, cache in LocalCache._registry.items():
+            stats = cache.stats()
+            lookups.add_metric([name, "hit"], stats["hits"])
+            lookups.add_metric([name, "miss"], stats["misses"])
+            evictions.add_metric([name], stats["evictions"])
+            entries.add_metric([name], stats["entries"])
+            size.add_metric([name], stats["bytes"])
+
+        yield from (lookups, evictions, entries, size)
+
+
+REGISTRY.register(LocalCacheCollector())
+
+
+def _observed(name: str, method: tp.Callable[..., tp.Awaitable[T]]) -> tp.Callable[..., tp.Awaitable[T]]:
+    # label children are resolved once, so that a call costs a clock read and two increments
+    latency = MONGO_QUERY_SECONDS.labels(name)
+    errors = MONGO_QUERY_ERRORS.labels(name)
+    documents = MONGO_DOCUMENTS.labels(name)
+
+    @functools.wraps(method)
+    async def wrapper(*args: tp.Any, **kwargs: tp.Any) -> T:
+        started = time.perf_counter()
+        try:
+            result = await method(*args, **kwargs)
+        except KeyError:
+            raise
+        except Exception:
+            errors.inc()
+            raise
+        finally:
+            latency.observe(time.perf_counter() - started)
+
+        if isinstance(result, list):
+            documents.inc(len(result))
+        elif result is not None and not isinstance(result, (int, dict)):
+            documents.inc()
+        return result
+
+    return wrapper
+
+
+def observe_queries(cls: tp.Type[T]) -> tp.Type[T]:
+    """time every public coroutine method of the class and count the documents it returns"""
+    for name, method in list(vars(cls).items()):
+        if not name.startswith("_") and inspect.iscoroutinefunction(method):
+            setattr(cls, name, _observed(name, method))
+    return cls
+
+
+class MetricsMiddleware:
+    """
+    Records request latency per route template, so that path parameters do not blow the label set up.
+    A plain ASGI middleware: unlike BaseHTTPMiddleware it neither buffers nor spawns tasks per request
+    """
+
+    def __init__(self, app: ASGIApp) -> None:
+        self.app = app
+        self._routes: tp.Dict[tp.Any, str] = {}
+        self._histograms: tp.Dict[tp.Tuple[str, str, int], tp.Any] = {}
+
+    def _route(self, scope: Scope) -> str:
+        endpoint = scope.get("endpoint")
+        if endpoint is None:
+            return "unmatched"
+
+        route = self._routes.get(endpoint)
+        if route is None:
+            for candidate in scope["app"].routes:
+                if getattr(candidate, "endpoint", None) is endpoint:
+                    route = self._routes[endpoint] = candidate.path
+                    break
+            else:
+                return "unmatched"
+        return route
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        started = time.perf_counter()
+        status = 500
+
+        async def send_with_status(message: Message) -> None:
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            elapsed = time.perf_counter() - started
+            labels = (scope["method"], self._route(scope), status)
+            histogram = self._histograms.get(labels)
+            if histogram is None:
+                histogram = self._histograms[labels] = REQUEST_SECONDS.labels(labels[0], labels[1], str(status))
+            histogram.observe(elapsed)
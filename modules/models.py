@@ -1,6 +1,9 @@
 from __future__ import annotations
 
+import base64
+import json
 import typing as tp
+from datetime import datetime
 
 from pydantic import BaseModel
 
@@ -17,3 +20,45 @@ class TokenData(BaseModel):
 class Token(BaseModel):
     access_token: str
     token_type: str
+    refresh_token: tp.Optional[str] = None
+
+
+class ProfileSummary(BaseModel):
+    id: str
+    method: str
+    path: str
+    total_ms: float
+    categories_ms: tp.Dict[str, float]
+    top: tp.List[str]
+
+
+class ProfileList(GenericResponse):
+    profiles: tp.List[ProfileSummary]
+
+
+class HistoryPage(BaseModel):
+    """a page of an event history, newest first, continuing after the last event of the previous page"""
+
+    limit: int = 100
+    since: tp.Optional[datetime] = None
+    until: tp.Optional[datetime] = None
+    after_timestamp: tp.Optional[datetime] = None
+    after_id: tp.Optional[str] = None
+
+    @staticmethod
+    def cursor_after(timestamp: datetime, id_: str) -> str:
+        """opaque continuation token pointing right behind the event"""
+        payload = json.dumps({"t": timestamp.isoformat(), "i": id_}, separators=(",", ":"))
+        return base64.urlsafe_b64encode(payload.encode()).decode().rstrip("=")
+
+    @classmethod
+    def from_cursor(cls, cursor: tp.Optional[str] = None, **kwargs: tp.Any) -> "HistoryPage":
+        """restore the page position from a continuation token, raises ValueError if the token is malformed"""
+        if cursor is None:
+            return cls(**kwargs)
+
+        try:
+            payload = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+            return cls(after_timestamp=datetime.fromisoformat(payload["t"]), after_id=str(payload["i"]), **kwargs)
+        except (TypeError, KeyError, ValueError) as e:
+            raise ValueError(f"Malformed cursor: {e}")
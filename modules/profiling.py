@@ -0,0 +1,196 @@
+import cProfile
+import marshal
+import os
+import pstats
+import random
+import time
+import typing as tp
+from urllib.parse import parse_qs
+from uuid import uuid4
+
+from fastapi import APIRouter, Depends, HTTPException, Response, status
+from loguru import logger
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from .cache import AsyncCache
+from .models import GenericResponse, ProfileList, ProfileSummary
+from .responses import TrustedRoute
+from .routers.user.models import User
+from .security import get_current_user
+
+PROFILING_ENABLED = os.getenv("PROFILING_ENABLED", "0") == "1"
+PROFILING_SAMPLE_RATE = float(os.getenv("PROFILING_SAMPLE_RATE", 0))
+PROFILING_TTL = int(os.getenv("PROFILING_TTL", 3600))
+PROFILING_HEADER = b"x-profile"
+PROFILING_KEEP = 100
+PROFILING_TOP = 5
+
+_RECENT_KEY = "profiles:recent"
+
+# tottime of a function is attributed to the first category whose marker is in its "file:function"
+_CATEGORIES: tp.Tuple[tp.Tuple[str, tp.Tuple[str, ...]], ...] = (
+    ("db", ("motor", "pymongo", "bson", "modules/database.py")),
+    ("cache", ("redis", "modules/cache.py", "local_cache.py", "chart_cache.py", "leaderboard.py", "singleflight.py")),
+    ("serialization", ("pydantic", "json", "fastapi/encoders.py", "fastapi/routing.py", "modules/responses.py")),
+    ("wait", ("selectors.py", "'select'", "'poll'", "'control'")),
+)
+
+
+def summarize(profile: cProfile.Profile, elapsed: float) -> tp.Tuple[tp.Dict[str, float], tp.List[str]]:
+    """split the profiled time by category and pick the functions with the highest own time"""
+    stats = pstats.Stats(profile).stats  # type: ignore
+    categories = dict.fromkeys([name for name, _ in _CATEGORIES], 0.0)
+    attributed = 0.0
+
+    for (filename, _, function), (_, _, own_time, _, _) in stats.items():
+        location = f"{filename}:{function}"
+        for name, markers in _CATEGORIES:
+            if any(marker in location for marker in markers):
+                categories[name] += own_time
+                attributed += own_time
+                break
+
+    categories["other"] = max(elapsed - attributed, 0.0)
+
+    top = sorted(stats.items(), key=lambda item: item[1][2], reverse=True)[:PROFILING_TOP]
+    return (
+        {name: round(seconds * 1e3, 2) for name, seconds in categories.items()},
+        [
+            f"{function} ({os.path.basename(filename)}:{line}) {row[2] * 1e3:.2f}ms"
+            for (filename, line, function), row in top
+        ],
+    )
+
+
+class ProfilingMiddleware:
+    """
+    Profiles requests with cProfile: the ones flagged by an admin with the X-Profile header
+    or ?profile=1, and a random PROFILING_SAMPLE_RATE share of all the others.
+    Profiling stops once the response starts, flagged requests get the summary in response headers,
+    every profile is stored in Redis for download from /profiles.
+    cProfile sees the whole event loop, so the work of concurrent requests shows up in the profile too,
+    and only one request is profiled at a time. Installed only when PROFILING_ENABLED=1
+    """
+
+    def __init__(self, app: ASGIApp, sample_rate: float = PROFILING_SAMPLE_RATE) -> None:
+        self.app = app
+        self.sample_rate = sample_rate
+        self._busy = False
+
+    @staticmethod
+    def _flagged(scope: Scope) -> bool:
+        if b"profile" in scope["query_string"] and parse_qs(scope["query_string"].decode()).get("profile") == ["1"]:
+            return True
+        return any(name == PROFILING_HEADER and value == b"1" for name, value in scope["headers"])
+
+    @staticmethod
+    async def _is_admin(scope: Scope) -> bool:
+        authorization = next((value for name, value in scope["headers"] if name == b"authorization"), b"").decode()
+        scheme, _, token = authorization.partition(" ")
+        if scheme.lower() != "bearer" or not token:
+            return False
+        try:
+            user = await get_current_user(token)
+        except HTTPException:
+            return False
+        return "admin" in user.permissions
+
+    @staticmethod
+    async def _store(profile: cProfile.Profile, summary: ProfileSummary) -> None:
+        cache = AsyncCache()
+        profile.create_stats()
+        await cache.set(f"profiles:{summary.id}", marshal.dumps(profile.stats), ttl=PROFILING_TTL)  # type: ignore
+
+        pipe = cache.client.pipeline(transaction=False)
+        pipe.lpush(_RECENT_KEY, summary.json())
+        pipe.ltrim(_RECENT_KEY, 0, PROFILING_KEEP - 1)
+        pipe.expire(_RECENT_KEY, PROFILING_TTL)
+        await cache.call(pipe.execute(), default=None, name="profile_index")
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http" or self._busy:
+            await self.app(scope, receive, send)
+            return
+
+        flagged = self._flagged(scope) and await self._is_admin(scope)
+        if not (flagged or random.random() < self.sample_rate) or self._busy:
+            await self.app(scope, receive, send)
+            return
+
+        self._busy = True
+        profile = cProfile.Profile()
+        profiling = True
+
+        async def send_profiled(message: Message) -> None:
+            nonlocal profiling
+            if message["type"] == "http.response.start" and profiling:
+                profile.disable()
+                profiling = False
+                elapsed = time.perf_counter() - started
+
+                categories, top = summarize(profile, elapsed)
+                summary = ProfileSummary(
+                    id=uuid4().hex,
+                    method=scope["method"],
+                    path=scope["path"],
+                    total_ms=round(elapsed * 1e3, 2),
+                    categories_ms=categories,
+                    top=top,
+                )
+                await self._store(profile, summary)
+                logger.info(f"profiled {summary.method} {summary.path} in {summary.total_ms}ms as {summary.id}")
+
+                if flagged:
+                    breakdown = " ".join(f"{name}={ms}ms" for name, ms in categories.items())
+                    message = {
+                        **message,
+                        "headers": [
+                            *message.get("headers", []),
+                            (b"x-profile-id", summary.id.encode()),
+                            (b"x-profile-summary", f"total={summary.total_ms}ms {breakdown}".encode()),
+                            (b"x-profile-top", "; ".join(top).encode("latin-1", errors="replace")),
+                        ],
+                    }
+            await send(message)
+
+        started = time.perf_counter()
+        profile.enable()
+        try:
+            await self.app(scope, receive, send_profiled)
+        finally:
+            if profiling:
+                profile.disable()
+            self._busy = False
+
+
+profiling_router = APIRouter(prefix="/profiles", route_class=TrustedRoute)
+
+
+@profiling_router.get("/", response_model=tp.Union[ProfileList, GenericResponse])  # type: ignore
+async def get_recent_profiles(user: User = Depends(get_current_user)) -> tp.Union[ProfileList, GenericResponse]:
+    """Summaries of the recently profiled requests, newest first"""
+    if "admin" not in user.permissions:
+        return GenericResponse(status_code=status.HTTP_403_FORBIDDEN, detail="Not enough permissions")
+
+    cache = AsyncCache()
+    summaries = await cache.call(cache.client.lrange(_RECENT_KEY, 0, -1), default=[], name="profile_index")
+    return ProfileList(profiles=[ProfileSummary.parse_raw(summary) for summary in summaries])
+
+
+@profiling_router.get("/{profile_id}", response_model=GenericResponse)
+async def download_profile(
+    profile_id: str, user: User = Depends(get_current_user)
+) -> tp.Union[Response, GenericResponse]:
+    """Download the profile in the pstats format, e.g. for `python -m pstats` or snakeviz"""
+    if "admin" not in user.permissions:
+        return GenericResponse(status_code=status.HTTP_403_FORBIDDEN, detail="Not enough permissions")
+
+    data = await AsyncCache().get(f"profiles:{profile_id}")
+    if data is None:
+        return GenericResponse(status_code=status.HTTP_404_NOT_FOUND, detail="Profile not found or expired")
+
+    return Response(
+        content=data,
+        media_type="application/octet-stream",
+        headers={"Content-Disposition": f'attachment; filename="{profile_id}.prof"'},
+    )
@@ -0,0 +1,58 @@
+import functools
+import inspect
+import typing as tp
+
+import orjson
+from fastapi.datastructures import DefaultPlaceholder
+from fastapi.responses import ORJSONResponse
+from fastapi.routing import APIRoute
+from pydantic import BaseModel
+from pydantic.json import pydantic_encoder
+from starlette.requests import Request
+from starlette.responses import Response
+
+
+class FastJSONResponse(ORJSONResponse):
+    """orjson response, models are dumped as is and the values orjson does not know are encoded like pydantic does"""
+
+    def render(self, content: tp.Any) -> bytes:
+        if isinstance(content, BaseModel):
+            content = content.dict()
+        return orjson.dumps(content, default=pydantic_encoder)
+
+
+class TrustedRoute(APIRoute):
+    """
+    A route whose endpoint returns models built out of validated input or our own documents.
+    Such models are written straight to the response, instead of being validated against the response model
+    once again and walked by jsonable_encoder; the response model still describes the endpoint in OpenAPI.
+    Anything else the endpoint returns goes through the regular FastAPI serialization, as does every route
+    whose response class is not FastJSONResponse
+    """
+
+    def get_route_handler(self) -> tp.Callable[[Request], tp.Coroutine[tp.Any, tp.Any, Response]]:
+        call = self.dependant.call
+        response_class = self.response_class
+        if isinstance(response_class, DefaultPlaceholder):
+            response_class = response_class.value
+
+        if inspect.iscoroutinefunction(call) and issubclass(response_class, FastJSONResponse):
+            self.dependant.call = _dump_models(call, response_class, self.status_code)
+        return super().get_route_handler()
+
+
+def _dump_models(
+    call: tp.Callable[..., tp.Awaitable[tp.Any]],
+    response_class: tp.Type[Response],
+    status_code: tp.Optional[int],
+) -> tp.Callable[..., tp.Awaitable[tp.Any]]:
+    response_args = {} if status_code is None else {"status_code": status_code}
+
+    @functools.wraps(call)
+    async def endpoint(**values: tp.Any) -> tp.Any:
+        content = await call(**values)
+        if isinstance(content, BaseModel):
+            return response_class(content, **response_args)
+        return content
+
+    return endpoint
@@ -0,0 +1,23 @@
+import typing as tp
+
+from fastapi import Query
+
+from .models import ChartPage, ChartScope
+
+CHART_PAGE_LIMIT = 100
+
+
+async def get_chart_page(
+    megafaculty: tp.Optional[str] = None,
+    faculty: tp.Optional[str] = None,
+    program: tp.Optional[str] = None,
+    group: tp.Optional[str] = None,
+    offset: int = Query(0, ge=0, description="number of top rows to skip"),
+    limit: int = Query(CHART_PAGE_LIMIT, ge=1, le=CHART_PAGE_LIMIT, description="number of rows to return"),
+    around: tp.Optional[int] = Query(None, ge=1, description="center the page on this rating position"),
+) -> ChartPage:
+    """get requested chart page"""
+    if around is not None:
+        offset = max(around - 1 - limit // 2, 0)
+
+    return ChartPage(scope=ChartScope.from_query(megafaculty, faculty, program, group), offset=offset, limit=limit)
@@ -3,6 +3,7 @@ from datetime import datetime
 
 from pydantic import BaseModel, Field
 
+from ..user.models import User
 from ...models import GenericResponse
 
 
@@ -22,4 +23,76 @@ class Chart(GenericResponse):
     """chart source data"""
 
     chart_data: tp.List[ChartEntry]
+    offset: int = 0
+    total: tp.Optional[int] = None
     generated_at: str = Field(default_factory=lambda: str(datetime.now()))
+
+
+class ScopeRank(BaseModel):
+    """user's position in a single chart scope"""
+
+    kind: str
+    value: tp.Optional[str] = None
+    rating_position: tp.Optional[int] = None
+    points: int = 0
+    total: int = 0
+
+
+class MyRanks(GenericResponse):
+    """user's positions across every scope they are ranked in"""
+
+    ranks: tp.List[ScopeRank]
+
+
+class ChartScope(BaseModel):
+    """a chart slice: the whole university or a single unit of its structure"""
+
+    kind: str = "university"
+    value: tp.Optional[str] = None
+
+    @property
+    def key(self) -> str:
+        """stable textual identifier of the scope"""
+        return self.kind if self.value is None else f"{self.kind}:{self.value}"
+
+    @classmethod
+    def from_query(
+        cls,
+        megafaculty: tp.Optional[str] = None,
+        faculty: tp.Optional[str] = None,
+        program: tp.Optional[str] = None,
+        group: tp.Optional[str] = None,
+    ) -> "ChartScope":
+        """pick the most specific scope out of the chart query filters"""
+        for kind, value in (("group", group), ("program", program), ("faculty", faculty), ("megafaculty", megafaculty)):
+            if value is not None:
+                return cls(kind=kind, value=value)
+        return cls()
+
+    @classmethod
+    def covering(cls, user: User) -> tp.List["ChartScope"]:
+        """all the scopes the user is ranked in"""
+        scopes = [cls()]
+        for kind in ("megafaculty", "faculty", "program", "group"):
+            value: tp.Optional[str] = getattr(user, kind)
+            if value is not None:
+                scopes.append(cls(kind=kind, value=value))
+        return scopes
+
+
+class ChartPage(BaseModel):
+    """a range of rows of the scope's chart"""
+
+    scope: ChartScope = Field(default_factory=ChartScope)
+    offset: int = 0
+    limit: int = 100
+
+    @property
+    def key(self) -> str:
+        """stable textual identifier of the page"""
+        return f"{self.scope.key}#{self.offset}:{self.limit}"
+
+    def blocks(self, size: int) -> tp.List["ChartPage"]:
+        """pages of the given size, aligned to it, which together hold every row of the page"""
+        offsets = range(self.offset - self.offset % size, self.offset + self.limit, size)
+        return [ChartPage(scope=self.scope, offset=offset, limit=size) for offset in offsets]
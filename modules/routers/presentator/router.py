@@ -1,106 +1,160 @@
-import time
 import typing as tp
 
-import redis
-from fastapi import APIRouter, status
+import orjson
+from fastapi import APIRouter, Depends, Response, status
 from loguru import logger
-from pydantic import parse_obj_as
 
-from .models import Chart, ChartEntry
+from .dependencies import CHART_PAGE_LIMIT, get_chart_page
+from .models import Chart, ChartEntry, ChartPage, MyRanks, ScopeRank
 from ..user.models import User
+from ...chart_cache import ChartCache
 from ...database import MongoDbWrapper
+from ...exceptions import MaterializationConflictError
+from ...leaderboard import LeaderboardEngine
+from ...materializer import materialize_charts
+from ...metrics import CHART_COMPUTE_SECONDS
 from ...models import GenericResponse
+from ...responses import TrustedRoute
+from ...security import get_current_user
+from ...singleflight import SingleFlight
 
-chart_router = APIRouter(prefix="/chart")
+chart_router = APIRouter(prefix="/chart", route_class=TrustedRoute)
 DB = MongoDbWrapper()
-REDIS = redis.Redis(host="redis", socket_connect_timeout=3)
+LEADERBOARD = LeaderboardEngine()
+CHART_CACHE = ChartCache()
+SINGLE_FLIGHT = SingleFlight("chart")
+
+
+async def _compute_chart(page: ChartPage) -> bytes:
+    """build chart page and put it to cache, unless the chart changes while it is being built"""
+    generation = await CHART_CACHE.generation(page.scope)
+    with CHART_COMPUTE_SECONDS.time():
+        if await LEADERBOARD.is_ready():
+            chart_data: tp.List[ChartEntry] = await LEADERBOARD.top(page.scope, limit=page.limit, offset=page.offset)
+            total = await LEADERBOARD.count(page.scope)
+        else:
+            chart_data = await DB.get_chart(page.scope, limit=page.limit, offset=page.offset)
+            total = await DB.count_chart(page.scope)
+
+        if not chart_data:
+            raise KeyError("Nothing to display")
 
+        # rows come from our own collections or the leaderboard built from them
+        chart = Chart.construct(
+            status_code=status.HTTP_200_OK,
+            detail=f"Success gathering chart of {len(chart_data)} rows",
+            chart_data=chart_data,
+            offset=page.offset,
+            total=total,
+        )
+        body = await CHART_CACHE.put(page, chart, generation)
 
-def _is_in_cache(query: tp.Tuple[str, str, str, str]) -> bool:
-    """check if query is available in cache"""
-    return REDIS.exists(str(query))
+    logger.info(f"cache added to redis. set to expire after {CHART_CACHE.ttl}s.")
+    return body
 
 
-def _cache_to_redis(query: tp.Tuple[str, str, str, str], chart_data: tp.List[ChartEntry]) -> None:
-    """save chart data to redis"""
-    ttl = 60 ** 2
-    REDIS.set(
-        name=str(query),
-        value=repr([entry.dict() for entry in chart_data]),
-        exat=int(time.time()) + ttl,
-    )
-    logger.info(f"cache added to redis. set to expire after {ttl}s.")
+async def _get_block(page: ChartPage) -> bytes:
+    """get serialized chart page from cache, computing it once on a miss"""
+    body = await CHART_CACHE.get(page)
 
+    if body is None and CHART_CACHE.stale_while_revalidate:
+        body = await CHART_CACHE.get_stale(page)
+        if body is not None:
+            SINGLE_FLIGHT.do_in_background(page.key, lambda: _compute_chart(page), lambda: CHART_CACHE.get(page))
 
-def _unpack_from_redis(query: tp.Tuple[str, str, str, str]) -> tp.List[ChartEntry]:
-    """het chart data to redis"""
-    data = eval(REDIS.get(name=str(query)))
-    return [parse_obj_as(ChartEntry, entry) for entry in data]
+    if body is None:
+        body = await SINGLE_FLIGHT.do(page.key, lambda: _compute_chart(page), lambda: CHART_CACHE.get(page))
+
+    return body
 
 
 @chart_router.get("/", response_model=tp.Union[Chart, GenericResponse])  # type: ignore
-async def get_leaderboard(
-    megafaculty: tp.Optional[str] = None,
-    faculty: tp.Optional[str] = None,
-    program: tp.Optional[str] = None,
-    group: tp.Optional[str] = None,
-) -> tp.Union[Chart, GenericResponse]:
-    """Get leaderboard by filter (megafaculty, faculty, program, group)"""
+async def get_leaderboard(page: ChartPage = Depends(get_chart_page)) -> tp.Union[Response, GenericResponse]:
+    """Get leaderboard page by filter (megafaculty, faculty, program, group)"""
 
     try:
-        query = (megafaculty, faculty, program, group)
+        # only aligned pages of the default size are cached, others are cut out of them
+        blocks = page.blocks(CHART_PAGE_LIMIT)
+        if blocks == [page]:
+            return Response(content=await _get_block(page), media_type="application/json")
+
+        charts: tp.List[tp.Dict[str, tp.Any]] = []
+        for block in blocks:
+            try:
+                charts.append(orjson.loads(await _get_block(block)))
+            except KeyError:
+                if not charts:
+                    raise
+                break
+
+        start = page.offset - blocks[0].offset
+        chart_data = [row for chart in charts for row in chart["chart_data"]][start : start + page.limit]
+        if not chart_data:
+            raise KeyError("Nothing to display")
+
+        chart = {
+            **charts[0],
+            "detail": f"Success gathering chart of {len(chart_data)} rows",
+            "chart_data": chart_data,
+            "offset": page.offset,
+        }
+        return Response(content=orjson.dumps(chart), media_type="application/json")
+    except KeyError as e:
+        return GenericResponse(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f"No matching results found for the provided query. {e}",
+        )
 
-        if REDIS.exists(str(query)):
-            logger.info("cache will be pulled from redis")
-            chart_data: tp.List[ChartEntry] = _unpack_from_redis(query)
-            logger.info("cache pulled successfully")
-        else:
-            if group is not None:
-                students: tp.List[User] = await DB.get_all_students_by_group(group)
-            elif program is not None:
-                students = await DB.get_all_students_by_program(program)
-            elif faculty is not None:
-                students = await DB.get_all_students_by_faculty(faculty)
-            elif megafaculty is not None:
-                students = await DB.get_all_students_by_megafaculty(megafaculty)
-            else:
-                students = await DB.get_all_students()
-
-            if not students:
-                raise KeyError("Nothing to display")
-
-            students.sort(key=lambda u: u.points, reverse=True)
-
-            chart_data = []
-
-            for position, student in enumerate(students, start=1):
-                entry = ChartEntry(
-                    name=student.name,
-                    megafaculty=str(student.megafaculty),
-                    faculty=str(student.faculty),
-                    program=str(student.program),
-                    group=str(student.group),
-                    points=student.points,
-                    rating_position=position,
-                )
-
-                chart_data.append(entry)
-
-                if position >= 100:
-                    break
-
-            _cache_to_redis(query, chart_data)
-
-        return Chart(
-            status_code=status.HTTP_200_OK,
-            detail=f"Success gathering chart of {len(chart_data)} rows",
-            chart_data=chart_data,
+    except Exception as e:
+        return GenericResponse(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"An internal error occurred: {e}",
         )
 
+
+@chart_router.get("/me", response_model=tp.Union[MyRanks, GenericResponse])  # type: ignore
+async def get_my_ranks(user: User = Depends(get_current_user)) -> tp.Union[MyRanks, GenericResponse]:
+    """Get current user's position in their group, program, faculty, megafaculty and university charts"""
+
+    try:
+        if user.is_teacher:
+            raise KeyError("Teachers are not ranked")
+
+        if await LEADERBOARD.is_ready():
+            ranks: tp.List[ScopeRank] = await LEADERBOARD.ranks(user)
+        else:
+            ranks = await DB.get_chart_ranks(user)
+
+        return MyRanks(ranks=ranks)
+
     except KeyError as e:
         return GenericResponse(
             status_code=status.HTTP_404_NOT_FOUND,
-            detail=f"No matching results found for the provided query. {e}",
+            detail=str(e),
+        )
+
+    except Exception as e:
+        return GenericResponse(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"An internal error occurred: {e}",
+        )
+
+
+@chart_router.post("/materialize", response_model=GenericResponse)
+async def materialize(user: User = Depends(get_current_user)) -> GenericResponse:
+    """Recompute the first page of every chart of the university structure and replace the cached charts"""
+
+    if "admin" not in user.permissions:
+        return GenericResponse(status_code=status.HTTP_403_FORBIDDEN, detail="Not enough permissions")
+
+    try:
+        count = await materialize_charts()
+        return GenericResponse(detail=f"{count} charts materialized")
+
+    except MaterializationConflictError as e:
+        return GenericResponse(
+            status_code=status.HTTP_409_CONFLICT,
+            detail=str(e),
         )
 
     except Exception as e:
@@ -56,6 +56,28 @@ class AchievementTemplateList(GenericResponse):
     achievement_templates: tp.List[AchievementTemplate]
 
 
+class BulkAchievementAward(BaseModel):
+    """Achievement awarded to a list of students or to the whole group or program"""
+
+    achievement_template_id: str
+    isu_ids: tp.Optional[tp.List[str]] = None
+    group: tp.Optional[str] = None
+    program: tp.Optional[str] = None
+
+
+class BulkAwardResult(BaseModel):
+    """Outcome of the award for a single student"""
+
+    isu_id: str
+    status_code: int = 200
+    detail: str = "Achievement assigned successful"
+    balance_upon_receival: tp.Optional[int] = None
+
+
+class BulkAwardResultList(GenericResponse):
+    results: tp.List[BulkAwardResult]
+
+
 class RewardEvent(BaseModel):
     """Reward event descriptor"""
 
@@ -1,25 +1,53 @@
+import asyncio
 import math
+import os
 import typing as tp
 
-from fastapi import APIRouter, Depends, status
+from fastapi import APIRouter, Depends, HTTPException, Response, status
+from loguru import logger
 
-from .dependencies import get_achievement_template, get_user_by_id
-from .models import AchievementEvent, AchievementTemplate, AchievementTemplateList, RewardEvent, RewardList
+from .models import (
+    AchievementEvent,
+    AchievementTemplateList,
+    BulkAchievementAward,
+    BulkAwardResult,
+    BulkAwardResultList,
+    RewardList,
+)
+from ..presentator.models import ChartScope
 from ..user.models import User
+from ...chart_cache import ChartCache
 from ...database import MongoDbWrapper
+from ...exceptions import InsufficientFundsError, OutOfStockError
+from ...leaderboard import LeaderboardEngine
+from ...local_cache import LocalCache
 from ...models import GenericResponse
-from ...security import get_current_user
+from ...responses import TrustedRoute
+from ...security import get_current_user, oauth2_scheme
 
-service_router = APIRouter(prefix="/service")
+service_router = APIRouter(prefix="/service", route_class=TrustedRoute)
 DB = MongoDbWrapper()
+LEADERBOARD = LeaderboardEngine()
+CHART_CACHE = ChartCache()
+CATALOG_CACHE = LocalCache(
+    "catalog",
+    max_bytes=int(os.getenv("CATALOG_LOCAL_CACHE_BYTES", 4 * 1024 ** 2)),
+    ttl=float(os.getenv("CATALOG_LOCAL_CACHE_TTL", 300)),
+)
 
 
 @service_router.get("/rewards", response_model=tp.Union[RewardList, GenericResponse])  # type: ignore
-async def get_available_rewards() -> tp.Union[RewardList, GenericResponse]:
+async def get_available_rewards() -> tp.Union[Response, GenericResponse]:
     """Get all available rewards"""
     try:
-        rewards = await DB.get_all_rewards()
-        return RewardList(rewards=rewards)
+        body: tp.Optional[bytes] = CATALOG_CACHE.get("rewards")
+
+        if body is None:
+            rewards = await DB.get_all_rewards()
+            body = RewardList(rewards=rewards).json(ensure_ascii=False).encode()
+            CATALOG_CACHE.set("rewards", body)
+
+        return Response(content=body, media_type="application/json")
 
     except KeyError as e:
         return GenericResponse(
@@ -38,24 +66,20 @@ async def get_available_rewards() -> tp.Union[RewardList, GenericResponse]:
 async def purchase_reward(reward_id: str, user: User = Depends(get_current_user)) -> GenericResponse:
     """Purchase reward, change user's balance"""
     try:
-        reward = await DB.get_reward_by_id(reward_id)
-
-        if user.coins < reward.price:
-            return GenericResponse(
-                status_code=status.HTTP_403_FORBIDDEN,
-                detail="Insufficient funds",
-            )
-
-        user.coins -= reward.price
-        await DB.update_user_data(user)
+        await DB.checkout(user.isu_id, reward_id)
+        return GenericResponse(detail="Purchase was successful")
 
-        purchase_event = RewardEvent(
-            reward_id=reward.id,
-            user_id=user.isu_id,
+    except InsufficientFundsError as e:
+        return GenericResponse(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail=str(e),
         )
-        await DB.add_reward_event(purchase_event)
 
-        return GenericResponse(detail="Purchase was successful")
+    except OutOfStockError as e:
+        return GenericResponse(
+            status_code=status.HTTP_409_CONFLICT,
+            detail=str(e),
+        )
 
     except KeyError as e:
         return GenericResponse(
@@ -71,11 +95,17 @@ async def purchase_reward(reward_id: str, user: User = Depends(get_current_user)
 
 
 @service_router.get("/achievements", response_model=tp.Union[AchievementTemplateList, GenericResponse])  # type: ignore
-async def get_achievement_templates() -> tp.Union[AchievementTemplateList, GenericResponse]:
+async def get_achievement_templates() -> tp.Union[Response, GenericResponse]:
     """Get all available achievement templates"""
     try:
-        achievements = await DB.get_all_achievements()
-        return AchievementTemplateList(achievement_templates=achievements)
+        body: tp.Optional[bytes] = CATALOG_CACHE.get("achievement-templates")
+
+        if body is None:
+            achievements = await DB.get_all_achievements()
+            body = AchievementTemplateList(achievement_templates=achievements).json(ensure_ascii=False).encode()
+            CATALOG_CACHE.set("achievement-templates", body)
+
+        return Response(content=body, media_type="application/json")
 
     except KeyError as e:
         return GenericResponse(
@@ -90,20 +120,41 @@ async def get_achievement_templates() -> tp.Union[AchievementTemplateList, Gener
         )
 
 
+async def _add_leaderboard_points_many(students: tp.List[User], points: int) -> None:
+    """leaderboard can be rebuilt from the database, so its failure must not fail the award"""
+    try:
+        await LEADERBOARD.add_points_many(students, points)
+    except Exception as e:
+        logger.warning(f"failed to update leaderboard for {len(students)} students, rebuild required: {e}")
+
+
+async def _publish_points(students: tp.List[User], points: int) -> None:
+    """move the students on the leaderboard before evicting their charts, so that a recomputed chart sees the points"""
+    await _add_leaderboard_points_many(students, points)
+    await CHART_CACHE.invalidate_for(*students)
+
+
 @service_router.post("/achievements", response_model=GenericResponse)
 async def add_user_achievement(
-    achievement: AchievementTemplate = Depends(get_achievement_template),
-    student: User = Depends(get_user_by_id),
-    teacher: User = Depends(get_current_user),
+    achievement_template_id: str,
+    isu_id: str,
+    token: str = Depends(oauth2_scheme),
 ) -> GenericResponse:
     """Add new achievement, associated with concrete user"""
     try:
+        teacher, achievement = await asyncio.gather(
+            get_current_user(token),
+            DB.get_achievement_template_by_id(achievement_template_id),
+        )
+
         if not (teacher.is_teacher and "write" in teacher.permissions):
             return GenericResponse(status_code=status.HTTP_403_FORBIDDEN, detail="Not enough permissions")
 
-        student.points += achievement.value
-        student.coins += math.ceil(achievement.value * 0.2)
-        await DB.update_user_data(student)
+        student = await DB.add_user_balance(
+            isu_id,
+            points=achievement.value,
+            coins=math.ceil(achievement.value * 0.2),
+        )
 
         achievement_event = AchievementEvent(
             user_id=student.isu_id,
@@ -112,10 +163,103 @@ async def add_user_achievement(
             estimated_income=achievement.value,
             balance_upon_receival=student.coins,
         )
-        await DB.add_achievement_event(achievement_event)
+        await asyncio.gather(
+            DB.add_achievement_event(achievement_event),
+            _publish_points([student], achievement.value),
+        )
 
         return GenericResponse(detail="Achievement assigned successful")
 
+    except HTTPException:
+        raise
+
+    except KeyError as e:
+        return GenericResponse(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=str(e),
+        )
+
+    except Exception as e:
+        return GenericResponse(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=str(e),
+        )
+
+
+@service_router.post(  # type: ignore
+    "/achievements/bulk", response_model=tp.Union[BulkAwardResultList, GenericResponse]
+)
+async def add_bulk_achievement(
+    award: BulkAchievementAward,
+    token: str = Depends(oauth2_scheme),
+) -> tp.Union[BulkAwardResultList, GenericResponse]:
+    """Add new achievement to each of the listed students or to every student of the group or program"""
+    try:
+        teacher, achievement = await asyncio.gather(
+            get_current_user(token),
+            DB.get_achievement_template_by_id(award.achievement_template_id),
+        )
+
+        if not (teacher.is_teacher and "write" in teacher.permissions):
+            return GenericResponse(status_code=status.HTTP_403_FORBIDDEN, detail="Not enough permissions")
+
+        if award.isu_ids is not None:
+            isu_ids = list(dict.fromkeys(award.isu_ids))
+        elif award.group is not None:
+            isu_ids = await DB.get_student_ids(ChartScope(kind="group", value=award.group))
+        elif award.program is not None:
+            isu_ids = await DB.get_student_ids(ChartScope(kind="program", value=award.program))
+        else:
+            return GenericResponse(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail="Either isu_ids, group or program has to be specified",
+            )
+
+        students, errors = await DB.add_users_balance(
+            isu_ids,
+            points=achievement.value,
+            coins=math.ceil(achievement.value * 0.2),
+        )
+
+        achievement_events = [
+            AchievementEvent(
+                user_id=student.isu_id,
+                creator_id=teacher.isu_id,
+                achievement_id=achievement.id,
+                estimated_income=achievement.value,
+                balance_upon_receival=student.coins,
+            )
+            for student in students
+        ]
+        await asyncio.gather(
+            DB.add_achievement_events(achievement_events),
+            _publish_points(students, achievement.value),
+        )
+
+        # the awards that went through are recorded above even if some of the others failed
+        balances = {student.isu_id: student.coins for student in students}
+        results = []
+        for isu_id in isu_ids:
+            if isu_id in balances:
+                results.append(BulkAwardResult(isu_id=isu_id, balance_upon_receival=balances[isu_id]))
+            elif isu_id in errors:
+                results.append(
+                    BulkAwardResult(
+                        isu_id=isu_id, status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=errors[isu_id]
+                    )
+                )
+            else:
+                results.append(
+                    BulkAwardResult(isu_id=isu_id, status_code=status.HTTP_404_NOT_FOUND, detail="Entry not found")
+                )
+        return BulkAwardResultList(
+            detail=f"Achievement assigned to {len(students)} of {len(isu_ids)} students",
+            results=results,
+        )
+
+    except HTTPException:
+        raise
+
     except KeyError as e:
         return GenericResponse(
             status_code=status.HTTP_404_NOT_FOUND,
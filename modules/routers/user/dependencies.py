@@ -0,0 +1,22 @@
+import os
+import typing as tp
+from datetime import datetime
+
+from fastapi import HTTPException, Query, status
+
+from ...models import HistoryPage
+
+HISTORY_PAGE_LIMIT = int(os.getenv("HISTORY_PAGE_LIMIT", 100))
+
+
+async def get_history_page(
+    cursor: tp.Optional[str] = Query(None, description="continuation token from the previous page"),
+    limit: int = Query(HISTORY_PAGE_LIMIT, ge=1, le=1000, description="number of events to return"),
+    since: tp.Optional[datetime] = Query(None, description="only events that happened at or after this moment"),
+    until: tp.Optional[datetime] = Query(None, description="only events that happened before this moment"),
+) -> HistoryPage:
+    """get requested page of an event history"""
+    try:
+        return HistoryPage.from_cursor(cursor, limit=limit, since=since, until=until)
+    except ValueError as e:
+        raise HTTPException(status.HTTP_400_BAD_REQUEST, str(e))
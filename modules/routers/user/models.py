@@ -38,7 +38,28 @@ class UsersOut(GenericResponse):
 
 class AchievementsOut(GenericResponse):
     achievements: tp.List[AchievementEvent]
+    next_cursor: tp.Optional[str] = None
 
 
 class PurchasesOut(GenericResponse):
     purchases: tp.List[RewardEvent]
+    next_cursor: tp.Optional[str] = None
+
+
+class ImportRowError(BaseModel):
+    """A rejected row of the user import"""
+
+    row: int
+    isu_id: tp.Optional[str] = None
+    detail: str
+
+
+class ImportProgress(BaseModel):
+    """Running totals of the user import, reported after every batch"""
+
+    rows: int = 0
+    upserted: int = 0
+    modified: int = 0
+    failed: int = 0
+    errors: tp.List[ImportRowError] = []
+    done: bool = False
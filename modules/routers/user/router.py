@@ -1,24 +1,40 @@
+import json
+import os
 import typing as tp
 
 from datetime import timedelta
 
-from fastapi import APIRouter, Depends, status
+from fastapi import APIRouter, Depends, File, Form, Query, UploadFile, status
+from fastapi.responses import StreamingResponse
 from fastapi.security import OAuth2PasswordRequestForm
 from loguru import logger
+from pydantic.json import pydantic_encoder
 
 from modules.database import MongoDbWrapper
 
+from .dependencies import get_history_page
 from ...exceptions import AuthException
-from ...models import GenericResponse, Token
+from ...importer import IMPORT_BATCH_SIZE, IMPORT_FORMATS, decode_lines, detect_format, import_users
+from ...models import GenericResponse, HistoryPage, Token
+from ...routers.service.models import AchievementEvent, RewardEvent
 from ...routers.user.models import AchievementsOut, User, UserOut, UsersOut, PurchasesOut
+from ...responses import TrustedRoute
 from ...security import (
     ACCESS_TOKEN_EXPIRE_MINUTES,
     authenticate_user,
     create_access_token,
+    create_refresh_token,
     get_current_user,
+    revoke_all_refresh_tokens,
+    revoke_refresh_token,
+    rotate_refresh_token,
 )
 
-user_router = APIRouter(prefix="/user")
+user_router = APIRouter(prefix="/user", route_class=TrustedRoute)
+Event = tp.TypeVar("Event", AchievementEvent, RewardEvent)
+
+USERS_STREAM_FORMATS = ("ndjson", "json")
+USERS_STREAM_BATCH_SIZE = int(os.getenv("USERS_STREAM_BATCH_SIZE", 500))
 
 
 @user_router.post("/login", response_model=tp.Union[Token, GenericResponse])  # type: ignore
@@ -33,7 +49,36 @@ async def login(form_data: OAuth2PasswordRequestForm = Depends()) -> Token:
         raise AuthException
     access_token_expires = timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
     access_token = create_access_token(data={"sub": user.isu_id}, expires_delta=access_token_expires)
-    return Token(access_token=access_token, token_type="bearer")
+    refresh_token = await create_refresh_token(user.isu_id)
+    return Token(access_token=access_token, token_type="bearer", refresh_token=refresh_token)
+
+
+@user_router.post("/refresh", response_model=Token)
+async def refresh(refresh_token: str = Form(...)) -> Token:
+    """
+    exchange a refresh token for a new access token
+    and a new refresh token, the old one is revoked
+    """
+    isu_id, new_refresh_token = await rotate_refresh_token(refresh_token)
+    access_token_expires = timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
+    access_token = create_access_token(data={"sub": isu_id}, expires_delta=access_token_expires)
+    return Token(access_token=access_token, token_type="bearer", refresh_token=new_refresh_token)
+
+
+@user_router.post("/logout", response_model=GenericResponse)
+async def logout(
+    refresh_token: tp.Optional[str] = Form(None),
+    everywhere: bool = Form(False),
+    user: User = Depends(get_current_user),
+) -> GenericResponse:
+    """revoke the refresh token, or every refresh token of the user"""
+    if everywhere:
+        await revoke_all_refresh_tokens(user.isu_id)
+    elif refresh_token is not None:
+        await revoke_refresh_token(refresh_token)
+    else:
+        return GenericResponse(status_code=status.HTTP_400_BAD_REQUEST, detail="Refresh token is required")
+    return GenericResponse(detail="Logged out")
 
 
 @user_router.get("/me", response_model=tp.Union[UserOut, GenericResponse])  # type: ignore
@@ -42,24 +87,143 @@ async def get_user_data(user: User = Depends(get_current_user)) -> UserOut:
     return UserOut(user=user)
 
 
+def _dump(document: tp.Dict[str, tp.Any]) -> str:
+    return json.dumps(document, default=pydantic_encoder, ensure_ascii=False)
+
+
+async def _stream_ndjson(batches: tp.AsyncIterator[tp.List[tp.Dict[str, tp.Any]]]) -> tp.AsyncIterator[str]:
+    """a user per line, a failure is reported as the last line"""
+    try:
+        async for batch in batches:
+            yield "".join(_dump(document) + "\n" for document in batch)
+    except Exception as e:
+        logger.error(f"user listing failed: {e}")
+        yield GenericResponse(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=str(e)).json() + "\n"
+
+
+async def _stream_json(batches: tp.AsyncIterator[tp.List[tp.Dict[str, tp.Any]]]) -> tp.AsyncIterator[str]:
+    """the same document UsersOut would produce, written a batch at a time"""
+    yield '{"status_code": 200, "detail": "Successful", "users": ['
+    separator = ""
+    try:
+        async for batch in batches:
+            yield separator + ", ".join(_dump(document) for document in batch)
+            separator = ", "
+    except Exception as e:
+        # the status is already sent, an unterminated document lets the client tell a partial listing apart
+        logger.error(f"user listing failed: {e}")
+        return
+    yield "]}"
+
+
 @user_router.get("/users", response_model=tp.Union[UsersOut, GenericResponse])  # type: ignore
-async def get_all_users(user: User = Depends(get_current_user)) -> tp.Union[UsersOut, GenericResponse]:
-    """get all known users"""
+async def get_all_users(
+    format_: tp.Optional[str] = Query(None, alias="format", description="stream users as ndjson or json"),
+    fields: tp.Optional[str] = Query(None, description="comma separated fields to return when streaming"),
+    megafaculty: tp.Optional[str] = None,
+    faculty: tp.Optional[str] = None,
+    program: tp.Optional[str] = None,
+    group: tp.Optional[str] = None,
+    is_teacher: tp.Optional[bool] = None,
+    batch_size: int = Query(USERS_STREAM_BATCH_SIZE, ge=1, le=10000),
+    user: User = Depends(get_current_user),
+) -> tp.Union[StreamingResponse, UsersOut, GenericResponse]:
+    """
+    get all known users, optionally filtered by the university structure.
+    with a format set the users are streamed straight from the cursor as they are read
+    """
     if not (user.is_teacher and "write" in user.permissions):
         return GenericResponse(status_code=status.HTTP_403_FORBIDDEN, detail="Not enough permissions")
-    users = await MongoDbWrapper().get_all_users()
-    return UsersOut(users=users)
+
+    filters = {"megafaculty": megafaculty, "faculty": faculty, "program": program, "group": group}
+    criteria: tp.Dict[str, tp.Any] = {key: value for key, value in filters.items() if value is not None}
+    if is_teacher is not None:
+        criteria["is_teacher"] = is_teacher
+
+    if format_ is None:
+        users = await MongoDbWrapper().get_all_users(criteria)
+        return UsersOut.construct(users=users)
+
+    if format_ not in USERS_STREAM_FORMATS:
+        return GenericResponse(status_code=status.HTTP_400_BAD_REQUEST, detail=f"Unsupported format {format_}")
+
+    projection = [field.strip() for field in fields.split(",") if field.strip()] if fields else None
+    unknown = set(projection or []) - set(User.__fields__)
+    if unknown:
+        return GenericResponse(
+            status_code=status.HTTP_400_BAD_REQUEST, detail=f"Unknown fields: {', '.join(sorted(unknown))}"
+        )
+
+    batches = MongoDbWrapper().iter_users(criteria, projection, batch_size)
+    if format_ == "ndjson":
+        return StreamingResponse(_stream_ndjson(batches), media_type="application/x-ndjson")
+    return StreamingResponse(_stream_json(batches), media_type="application/json")
+
+
+def _paginate(events: tp.List[Event], page: HistoryPage) -> tp.Tuple[tp.List[Event], tp.Optional[str]]:
+    """cut the event over the limit off the page, its presence means there is a next page"""
+    if len(events) <= page.limit:
+        return events, None
+    events = events[: page.limit]
+    return events, HistoryPage.cursor_after(events[-1].timestamp, events[-1].id)
 
 
 @user_router.get("/achievements", response_model=tp.Union[AchievementsOut, GenericResponse])  # type: ignore
-async def get_user_achievements(user: User = Depends(get_current_user)) -> AchievementsOut:
-    """return achievement data for the requested user"""
-    achievements = await MongoDbWrapper().get_all_recieved_achievements_for_user(user=user)
-    return AchievementsOut(achievements=achievements)
+async def get_user_achievements(
+    page: HistoryPage = Depends(get_history_page), user: User = Depends(get_current_user)
+) -> AchievementsOut:
+    """return a page of achievement data for the requested user, newest first"""
+    achievements, next_cursor = _paginate(await MongoDbWrapper().get_recieved_achievements_page(user, page), page)
+    return AchievementsOut.construct(achievements=achievements, next_cursor=next_cursor)
+
+
+@user_router.get("/created-achievements", response_model=tp.Union[AchievementsOut, GenericResponse])  # type: ignore
+async def get_created_achievements(
+    page: HistoryPage = Depends(get_history_page), user: User = Depends(get_current_user)
+) -> tp.Union[AchievementsOut, GenericResponse]:
+    """return a page of achievements awarded by the requested teacher, newest first"""
+    if not user.is_teacher:
+        return GenericResponse(status_code=status.HTTP_403_FORBIDDEN, detail="Not enough permissions")
+    achievements, next_cursor = _paginate(await MongoDbWrapper().get_created_achievements_page(user, page), page)
+    return AchievementsOut.construct(achievements=achievements, next_cursor=next_cursor)
 
 
 @user_router.get("/purchase-history", response_model=PurchasesOut)
-async def get_user_achievements(user: User = Depends(get_current_user)) -> PurchasesOut:
-    """return purchase data for the requested user"""
-    rewards = await MongoDbWrapper().get_all_reward_events_for_user(user=user)
-    return PurchasesOut(purchases=rewards)
+async def get_user_purchases(
+    page: HistoryPage = Depends(get_history_page), user: User = Depends(get_current_user)
+) -> PurchasesOut:
+    """return a page of purchase data for the requested user, newest first"""
+    purchases, next_cursor = _paginate(await MongoDbWrapper().get_reward_events_page(user, page), page)
+    return PurchasesOut.construct(purchases=purchases, next_cursor=next_cursor)
+
+
+@user_router.post("/import", response_model=GenericResponse)
+async def import_users_file(
+    file: UploadFile = File(...),
+    format_: tp.Optional[str] = Query(None, alias="format"),
+    batch_size: int = Query(IMPORT_BATCH_SIZE, ge=1, le=10000),
+    skip: int = Query(0, ge=0),
+    user: User = Depends(get_current_user),
+) -> tp.Union[StreamingResponse, GenericResponse]:
+    """
+    create or update users from an NDJSON or CSV file,
+    the progress of every batch is streamed back as NDJSON
+    """
+    if "admin" not in user.permissions:
+        return GenericResponse(status_code=status.HTTP_403_FORBIDDEN, detail="Not enough permissions")
+
+    format_ = format_ or detect_format(file.filename or "")
+    if format_ not in IMPORT_FORMATS:
+        return GenericResponse(status_code=status.HTTP_400_BAD_REQUEST, detail=f"Unsupported import format {format_}")
+
+    async def report() -> tp.AsyncIterator[str]:
+        try:
+            async for progress in import_users(decode_lines(file.file), format_, batch_size, skip):
+                yield progress.json(ensure_ascii=False) + "\n"
+        except Exception as e:
+            logger.error(f"user import failed: {e}")
+            yield GenericResponse(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=str(e)).json() + "\n"
+        finally:
+            await file.close()
+
+    return StreamingResponse(report(), media_type="application/x-ndjson")
@@ -1,27 +1,46 @@
+import asyncio
+import hashlib
 import os
+import secrets
+import time
 import typing as tp
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 
-from pydantic import parse_obj_as
 from fastapi import Depends, HTTPException
 from fastapi.security import OAuth2PasswordBearer
 from jose import JWTError, jwt
 from passlib.context import CryptContext
-from loguru import logger
 
 from .routers.user.models import UserWithPassword, User
 
+from .cache import AsyncCache
 from .database import MongoDbWrapper
-from .exceptions import CredentialsValidationException
+from .exceptions import CredentialsValidationException, ServiceUnavailableException
+from .local_cache import LocalCache
+from .metrics import PASSWORD_HASHER_PENDING, PASSWORD_HASHER_QUEUE_DEPTH
 from .models import TokenData
+from .singleton import SingletonMeta
 
 SECRET_KEY = os.environ.get("SECRET_KEY")
 ACCESS_TOKEN_EXPIRE_MINUTES = 60
+REFRESH_TOKEN_EXPIRE_DAYS = int(os.getenv("REFRESH_TOKEN_EXPIRE_DAYS", 30))
 ALGORITHM = "HS256"
+T = tp.TypeVar("T")
 
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="user/login")
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 
+# decoded claims by token hash and users by isu_id, users are invalidated by the MongoDbWrapper methods changing them:
+# add_user_balance, add_users_balance, checkout and upsert_users
+PRINCIPAL_CACHE_TTL = float(os.getenv("PRINCIPAL_CACHE_TTL", 30))
+CLAIMS_CACHE = LocalCache(
+    "claims", max_bytes=int(os.getenv("CLAIMS_CACHE_BYTES", 4 * 1024 ** 2)), ttl=PRINCIPAL_CACHE_TTL
+)
+PRINCIPAL_CACHE = LocalCache(
+    "principal", max_bytes=int(os.getenv("PRINCIPAL_CACHE_BYTES", 16 * 1024 ** 2)), ttl=PRINCIPAL_CACHE_TTL
+)
+
 
 def verify_password(plain_password: str, hashed_password: str) -> bool:
     return bool(pwd_context.verify(plain_password, hashed_password))
@@ -31,6 +50,42 @@ def get_password_hash(password: str) -> str:
     return str(pwd_context.hash(password))
 
 
+class PasswordHasher(metaclass=SingletonMeta):
+    """
+    Runs bcrypt in a dedicated thread pool, so that it never blocks the event loop.
+    Calls beyond the pool size wait in a bounded queue, the ones that do not fit are rejected with 503.
+    """
+
+    def __init__(self) -> None:
+        self.workers = int(os.getenv("PASSWORD_HASHER_WORKERS", os.cpu_count() or 1))
+        self.max_queue = int(os.getenv("PASSWORD_HASHER_QUEUE", 32))
+        self.pending = 0
+        self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="bcrypt")
+        PASSWORD_HASHER_QUEUE_DEPTH.set_function(lambda: self.queue_depth)
+        PASSWORD_HASHER_PENDING.set_function(lambda: self.pending)
+
+    @property
+    def queue_depth(self) -> int:
+        """number of calls waiting for a free worker"""
+        return max(self.pending - self.workers, 0)
+
+    async def _run(self, function: tp.Callable[..., T], *args: tp.Any) -> T:
+        if self.pending >= self.workers + self.max_queue:
+            raise ServiceUnavailableException(details="Too many concurrent logins, try again later")
+
+        self.pending += 1
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self._executor, function, *args)
+        finally:
+            self.pending -= 1
+
+    async def verify(self, plain_password: str, hashed_password: str) -> bool:
+        return await self._run(verify_password, plain_password, hashed_password)
+
+    async def hash(self, password: str) -> str:
+        return await self._run(get_password_hash, password)
+
+
 def create_access_token(
     data: tp.Dict[str, tp.Union[datetime, str]],
     expires_delta: timedelta = timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES),
@@ -42,33 +97,108 @@ def create_access_token(
     return encoded_jwt
 
 
+def _refresh_token_key(refresh_token: str) -> str:
+    """refresh tokens are stored by their hash, so that a leaked redis dump can not be used to log in"""
+    return f"refresh-token:{hashlib.sha256(refresh_token.encode()).hexdigest()}"
+
+
+async def create_refresh_token(isu_id: str) -> tp.Optional[str]:
+    """issue a long-lived opaque refresh token for the user, None if it could not be stored"""
+    refresh_token = secrets.token_urlsafe(32)
+    cache = AsyncCache()
+    ttl = int(timedelta(days=REFRESH_TOKEN_EXPIRE_DAYS).total_seconds())
+
+    pipe = cache.client.pipeline(transaction=True)
+    pipe.set(_refresh_token_key(refresh_token), isu_id, ex=ttl)
+    pipe.sadd(f"refresh-tokens:{isu_id}", _refresh_token_key(refresh_token))
+    pipe.expire(f"refresh-tokens:{isu_id}", ttl)
+    if await cache.call(pipe.execute(), default=None, name="refresh_token_issue") is None:
+        return None
+
+    return refresh_token
+
+
+async def rotate_refresh_token(refresh_token: str) -> tp.Tuple[str, tp.Optional[str]]:
+    """consume the refresh token and issue a new one, every refresh token can be used only once"""
+    cache = AsyncCache()
+    isu_id: tp.Optional[bytes] = await cache.call(
+        cache.client.getdel(_refresh_token_key(refresh_token)), default=None, name="refresh_token_consume"
+    )
+
+    if isu_id is None:
+        raise CredentialsValidationException(details="Invalid or expired refresh token")
+
+    await cache.call(
+        cache.client.srem(f"refresh-tokens:{isu_id.decode()}", _refresh_token_key(refresh_token)),
+        None,
+        name="refresh_token_forget",
+    )
+    return isu_id.decode(), await create_refresh_token(isu_id.decode())
+
+
+async def revoke_refresh_token(refresh_token: str) -> None:
+    """make the refresh token unusable"""
+    cache = AsyncCache()
+    isu_id: tp.Optional[bytes] = await cache.call(
+        cache.client.getdel(_refresh_token_key(refresh_token)), default=None, name="refresh_token_consume"
+    )
+
+    if isu_id is not None:
+        await cache.call(
+            cache.client.srem(f"refresh-tokens:{isu_id.decode()}", _refresh_token_key(refresh_token)),
+            None,
+            name="refresh_token_forget",
+        )
+
+
+async def revoke_all_refresh_tokens(isu_id: str) -> None:
+    """make every refresh token of the user unusable"""
+    cache = AsyncCache()
+    keys: tp.Set[bytes] = await cache.call(
+        cache.client.smembers(f"refresh-tokens:{isu_id}"), default=set(), name="refresh_token_list"
+    )
+    await cache.delete(f"refresh-tokens:{isu_id}", *[key.decode() for key in keys])
+
+
 async def authenticate_user(isu_number: str, password: str) -> tp.Optional[UserWithPassword]:
     user_data = await MongoDbWrapper().get_user_by_isu_id(isu_number)
     if not user_data:
         return None
-    if not verify_password(password, user_data.hashed_password):
+    if not await PasswordHasher().verify(password, user_data.hashed_password):
         return None
     return user_data
 
 
 async def get_current_user(token: str = Depends(oauth2_scheme)) -> User:
-    logger.info(f"got token {token}")
-    try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        logger.info(payload)
-        username: str = payload.get("sub")
-        if username is None:
+    token_hash = hashlib.sha256(token.encode()).hexdigest()
+    token_data: tp.Optional[TokenData] = CLAIMS_CACHE.get(token_hash)
+
+    if token_data is None:
+        try:
+            payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+            username: str = payload.get("sub")
+            # every token we issue expires, one that never does was not issued by us
+            expires: tp.Optional[float] = payload.get("exp")
+            if username is None or expires is None:
+                raise CredentialsValidationException
+            token_data = TokenData(username=username)
+        except JWTError:
             raise CredentialsValidationException
-        token_data = TokenData(username=username)
-    except JWTError:
-        raise CredentialsValidationException
 
-    try:
-        user: UserWithPassword = await MongoDbWrapper().get_user_by_isu_id(token_data.username)
-    except Exception as e:
-        raise HTTPException(404, str(e))
+        # claims must not outlive the token itself
+        ttl = min(PRINCIPAL_CACHE_TTL, expires - time.time())
+        CLAIMS_CACHE.set(token_hash, token_data, ttl=ttl, size=len(token_hash) + len(username))
+
+    user: tp.Optional[User] = PRINCIPAL_CACHE.get(token_data.username)
+
+    if user is None:
+        try:
+            user_data: UserWithPassword = await MongoDbWrapper().get_user_by_isu_id(token_data.username)
+        except Exception as e:
+            raise HTTPException(404, str(e))
 
-    user_dict = user.dict(exclude={"hashed_password"})
-    logger.info(f"user: {user_dict}")
+        user = User.construct(**user_data.dict(exclude={"hashed_password"}))
+        PRINCIPAL_CACHE.set(token_data.username, user, size=len(user.json()))
 
-    return parse_obj_as(User, user_dict)
+    # handlers are free to modify the user they get
+    return user.copy()
@@ -0,0 +1,130 @@
+import asyncio
+import time
+import typing as tp
+from uuid import uuid4
+
+from loguru import logger
+
+from .cache import AsyncCache
+
+T = tp.TypeVar("T")
+
+# deletes the lock only if it is still held by the caller
+_RELEASE_LOCK_SCRIPT = """
+if redis.call("get", KEYS[1]) == ARGV[1] then
+    return redis.call("del", KEYS[1])
+end
+return 0
+"""
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent computations of the same key into a single one.
+    Coroutines of a process share one in-flight computation, workers coordinate through a short Redis lock:
+    the lock holder computes and publishes the result, the rest poll for the published result.
+    """
+
+    def __init__(
+        self,
+        namespace: str,
+        lock_ttl: float = 10.0,
+        wait_timeout: float = 5.0,
+        poll_interval: float = 0.05,
+    ) -> None:
+        self._namespace = namespace
+        self._lock_ttl = lock_ttl
+        self._wait_timeout = wait_timeout
+        self._poll_interval = poll_interval
+        self._cache = AsyncCache()
+        self._in_flight: tp.Dict[str, "asyncio.Future[tp.Any]"] = {}
+        self._background: tp.Set["asyncio.Task[tp.Any]"] = set()
+
+    async def do(
+        self,
+        key: str,
+        compute: tp.Callable[[], tp.Awaitable[T]],
+        lookup: tp.Callable[[], tp.Awaitable[tp.Optional[T]]],
+    ) -> T:
+        """
+        run compute once per key across coroutines and workers,
+        lookup fetches the result published by a computation running elsewhere
+        """
+        in_flight = self._in_flight.get(key)
+        if in_flight is not None:
+            return tp.cast(T, await asyncio.shield(in_flight))
+
+        future: "asyncio.Future[T]" = asyncio.get_running_loop().create_future()
+        self._in_flight[key] = future
+
+        try:
+            result = await self._run_exclusively(key, compute, lookup)
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            future.exception()  # waiters re-raise it, it must not be reported as never retrieved
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            del self._in_flight[key]
+
+    def do_in_background(
+        self,
+        key: str,
+        compute: tp.Callable[[], tp.Awaitable[T]],
+        lookup: tp.Callable[[], tp.Awaitable[tp.Optional[T]]],
+    ) -> None:
+        """same as do, without waiting for the result"""
+        task = asyncio.create_task(self.do(key, compute, lookup))
+        self._background.add(task)
+        task.add_done_callback(self._on_background_done)
+
+    def _on_background_done(self, task: "asyncio.Task[tp.Any]") -> None:
+        self._background.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            logger.warning(f"background computation failed: {task.exception()!r}")
+
+    async def _run_exclusively(
+        self,
+        key: str,
+        compute: tp.Callable[[], tp.Awaitable[T]],
+        lookup: tp.Callable[[], tp.Awaitable[tp.Optional[T]]],
+    ) -> T:
+        """compute under the cross-worker lock or wait for the worker holding it"""
+        lock_key = f"{self._namespace}:lock:{key}"
+        token = uuid4().hex
+        deadline = time.monotonic() + self._wait_timeout
+
+        while True:
+            # redis being unavailable must not stop the computation, so a failed attempt counts as acquired
+            acquired = await self._cache.call(
+                self._cache.client.set(lock_key, token, nx=True, px=int(self._lock_ttl * 1000)),
+                default=True,
+                name="lock",
+            )
+
+            if acquired:
+                try:
+                    published = await lookup()
+                    return published if published is not None else await compute()
+                finally:
+                    await self._cache.call(
+                        self._cache.client.eval(_RELEASE_LOCK_SCRIPT, 1, lock_key, token), None, name="unlock"
+                    )
+
+            while time.monotonic() < deadline:
+                await asyncio.sleep(self._poll_interval)
+
+                published = await lookup()
+                if published is not None:
+                    return published
+
+                if not await self._cache.call(self._cache.client.exists(lock_key), default=0, name="lock_exists"):
+                    break  # the holder gave up without publishing, try to take over
+            else:
+                logger.warning(f"timed out waiting for {lock_key}, computing without the lock")
+                return await compute()
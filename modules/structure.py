@@ -0,0 +1,28 @@
+# megafaculty -> faculty -> program -> group, every unit of the structure has its own chart
+university_structure = {
+    "МФ ТИНТ": {
+        "ФИКТ": {
+            "Прикладная информатика": "K3141",
+            "Инфокоммуникационные технологии и системы связи": "K3121",
+        },
+        "ФИТИП": {
+            "Прикладная математика и информатика": "M3138",
+            "Информационные системы и технологии": "M3105",
+        },
+    },
+    "МФ КТУ": {
+        "ФПИиКТ": {
+            "Информатика и вычислительная техника": "P3132",
+            "Программная инженерия": "P3120",
+        },
+        "ФБИТ": {
+            "Информационная безопасность": "N3145",
+            "Конструирование и технология электронных средств": "N3156",
+        },
+        "ФСУиР": {"Робототехника": "R3135", "Приборостроение": "R4157"},
+    },
+    "ФТ МФ": {
+        "ИИФ": {"Оптотехника": "B3100"},
+        "ФФ": {"Фотоника и оптоинформатика": "L3122", "Техническая физика": "L3199"},
+    },
+}
@@ -1,43 +1,12 @@
 from datetime import datetime, timedelta
+import functools
 import typing as tp
 import random
 
-from faker import Faker
-from faker.providers import DynamicProvider
+from .structure import university_structure
 
-from modules.routers.user.models import UserWithPassword
-from app import DB
-
-# from .. import routers
-
-
-university_structure = {
-    "МФ ТИНТ": {
-        "ФИКТ": {
-            "Прикладная информатика": "K3141",
-            "Инфокоммуникационные технологии и системы связи": "K3121",
-        },
-        "ФИТИП": {
-            "Прикладная математика и информатика": "M3138",
-            "Информационные системы и технологии": "M3105",
-        },
-    },
-    "МФ КТУ": {
-        "ФПИиКТ": {
-            "Информатика и вычислительная техника": "P3132",
-            "Программная инженерия": "P3120",
-        },
-        "ФБИТ": {
-            "Информационная безопасность": "N3145",
-            "Конструирование и технология электронных средств": "N3156",
-        },
-        "ФСУиР": {"Робототехника": "R3135", "Приборостроение": "R4157"},
-    },
-    "ФТ МФ": {
-        "ИИФ": {"Оптотехника": "B3100"},
-        "ФФ": {"Фотоника и оптоинформатика": "L3122", "Техническая физика": "L3199"},
-    },
-}
+if tp.TYPE_CHECKING:
+    from faker import Faker
 
 
 Student = tp.Dict[str, tp.Union[int, str, bool]]
@@ -50,8 +19,16 @@ def gen_datetime(min_year: int = 2001, max_year=2003):
     return start + (end - start) * random.random()
 
 
+@functools.lru_cache(maxsize=None)
+def get_faker() -> "Faker":
+    """faker is a dev dependency and slow to set up, so it is only built by the first fake student"""
+    from faker import Faker
+
+    return Faker(locale=["ru_RU"])
+
+
 def generate_fake_student(context: tp.Optional[tp.Dict[str, str]] = None) -> Student:
-    fake_data = Faker(locale=["ru_RU"])
+    fake_data = get_faker()
     if not context:
         megafaculty: str = random.choice(list(university_structure))
         faculty: str = random.choice(list(university_structure[megafaculty]))
@@ -204,18 +181,15 @@ rewards = [
         "thumbnail": "https://news.itmo.ru/images/news/big/960500.jpg",
         "price": 1000,
         "description": "А еще спросить зачем нам 3 семестра физики.",
-    }
+    },
+    {
+        "name": "Стикерпак ИТМО",
+        "price": 5,
+        "description": "Набор стикеров с символикой университета.",
+    },
+    {
+        "name": "Футболка ИТМО",
+        "price": 25,
+        "description": "Футболка с логотипом университета.",
+    },
 ]
-
-import asyncio
-
-from app import DB
-from modules.routers.service.models import Reward
-
-
-async def a():
-    for _ in rewards:
-        await DB.add_reward(Reward(**_))
-
-
-asyncio.get_event_loop().run_until_complete(a())